@@ -32,7 +32,8 @@ setuptools.setup(
     keywords='wavefront wavefront_integration collector metrics',
     url='https://www.wavefront.com',
     install_requires=['wavefront_client', 'python-dateutil', 'logging',
-                      'python-daemon>=2.1.1', 'boto3', 'ndg-httpsclient'],
+                      'python-daemon>=2.1.1', 'boto3', 'ndg-httpsclient',
+                      'requests'],
     classifiers=[
         'Development Status :: 4 - Beta',
         'Topic :: Utilities',
@@ -0,0 +1,66 @@
+import sys
+import unittest
+
+sys.path.append('..')
+from wavefront.metrics_writer import WavefrontMetricsWriter, prepare_tags
+
+class TestPrepareTags(unittest.TestCase):
+
+    def test_no_tags(self):
+        """
+        Tests that no (or empty) point tags render as an empty string
+        """
+
+        self.assertEqual(prepare_tags(None), '')
+        self.assertEqual(prepare_tags({}), '')
+
+    def test_single_tag(self):
+        self.assertEqual(prepare_tags({'app': 'web'}), ' "app"="web"')
+
+    def test_multiple_tags(self):
+        tags = prepare_tags({'k1': 'v1', 'k2': 'v2'})
+        self.assertEqual(sorted(tags.split(' ')[1:]),
+                         ['"k1"="v1"', '"k2"="v2"'])
+        self.assertTrue(tags.startswith(' '))
+
+    def test_quotes_are_escaped(self):
+        """
+        Tests that double quotes in keys and values are escaped
+        """
+
+        self.assertEqual(prepare_tags({'a"b': 'say "hi"'}),
+                         ' "a\\"b"="say \\"hi\\""')
+
+    def test_backslashes_are_escaped(self):
+        """
+        Tests that backslashes are escaped (before the quotes) so that a
+        value ending in a backslash does not escape the closing quote
+        """
+
+        self.assertEqual(prepare_tags({'k': 'foo\\'}), ' "k"="foo\\\\"')
+        self.assertEqual(prepare_tags({'k': 'a\\"b'}),
+                         ' "k"="a\\\\\\"b"')
+        self.assertEqual(prepare_tags({'a\\b': 'c'}), ' "a\\\\b"="c"')
+
+    def test_non_string_values(self):
+        self.assertEqual(prepare_tags({'server_id': 1234}),
+                         ' "server_id"="1234"')
+
+    def test_prepared_tags_same_as_dictionary(self):
+        """
+        Tests that a line generated from the prepare_tags() string is the
+        same as one generated from the dictionary
+        """
+
+        writer = WavefrontMetricsWriter('localhost', 2878)
+        tags = {'app': 'web "1"'}
+        # pylint: disable=protected-access
+        self.assertEqual(
+            writer._generate_line('a.b', 1, 100, 'src', tags),
+            writer._generate_line('a.b', 1, 100, 'src', prepare_tags(tags)))
+        self.assertEqual(
+            writer._generate_line('a.b', 1, 100, 'src', tags),
+            'a.b 1 100 source="src" "app"="web \\"1\\""')
+
+if __name__ == '__main__':
+    unittest.main()
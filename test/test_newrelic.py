@@ -0,0 +1,254 @@
+import marshal
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.append('..')
+from wavefront import newrelic
+from wavefront.newrelic import (MetricNameFilter,
+                                NewRelicMetricRetrieverCommand, RegexList,
+                                compile_regex_union)
+
+# metric names like the ones returned by the metrics.json API
+NAMES = [
+    'Apdex', 'Apdex/Controller/users/show', 'HttpDispatcher',
+    'Errors/all', 'Errors/allWeb', 'Datastore/all', 'Datastore/MySQL/all',
+    'Datastore/statement/MySQL/users/select', 'Memcached/get',
+    'External/all', 'External/api.example.com/all', 'WebTransaction',
+    'WebTransaction/Uri/index.html', 'CPU/User Time', 'Memory/Physical',
+    'Custom/a.b|c', 'apdex', ''
+]
+
+# filter expressions as found in the configuration file: literal prefixes,
+# literal exact names ("name\Z") and regular expressions
+PATTERNS = [
+    'Apdex', 'HttpDispatcher$', r'Errors/all\Z', 'Datastore/', 'External',
+    r'Memcached/get\Z', r'WebTransaction/Uri/.*\.html', 'CPU/.*',
+    r'Custom/a\.b\|c$', '.*all$', 'Memory/(Physical|Used)$', 'apdex$',
+    'Web.*', 'Nothing[0-9]+', 'Errors/all'
+]
+
+def _re_match_any(patterns, name):
+    """
+    The original semantics: any pattern matches the name with re.match()
+    """
+
+    return any(re.match(pattern, name) for pattern in patterns)
+
+class TestMetricNameFilter(unittest.TestCase):
+
+    def test_match_same_as_re_match(self):
+        """
+        Tests that match() agrees with re.match() of each pattern for every
+        combination of prefix, exact and regular expression patterns
+        """
+
+        rand = random.Random(1234)
+        for _ in range(200):
+            patterns = rand.sample(PATTERNS, rand.randint(1, len(PATTERNS)))
+            name_filter = MetricNameFilter(patterns)
+            for name in NAMES:
+                self.assertEqual(name_filter.match(name),
+                                 _re_match_any(patterns, name),
+                                 '%s %s' % (patterns, name))
+
+    def test_filter_same_as_re_match(self):
+        """
+        Tests that filter() keeps (white list) or drops (black list) the same
+        names as re.match() of each pattern
+        """
+
+        rand = random.Random(5678)
+        for _ in range(200):
+            patterns = rand.sample(PATTERNS, rand.randint(1, len(PATTERNS)))
+            name_filter = MetricNameFilter(patterns)
+            self.assertEqual(
+                name_filter.filter(NAMES),
+                [name for name in NAMES if _re_match_any(patterns, name)])
+            self.assertEqual(
+                name_filter.filter(NAMES, False),
+                [name for name in NAMES
+                 if not _re_match_any(patterns, name)])
+
+    def test_literal_patterns_only(self):
+        name_filter = MetricNameFilter(['Apdex', r'HttpDispatcher\Z'])
+        self.assertIsNone(name_filter.regex)
+        self.assertEqual(name_filter.filter(['Apdex/x', 'HttpDispatcher',
+                                             'HttpDispatcher/x', 'Other']),
+                         ['Apdex/x', 'HttpDispatcher'])
+
+    def test_exact_pattern_is_not_prefix(self):
+        for pattern in ('Errors/all$', r'Errors/all\Z'):
+            name_filter = MetricNameFilter([pattern])
+            self.assertTrue(name_filter.match('Errors/all'))
+            self.assertFalse(name_filter.match('Errors/allWeb'))
+
+    def test_exact_pattern_trailing_newline(self):
+        """
+        Tests that "name$" still matches before a trailing newline (as with
+        re.match()) while "name\\Z" (set lookup) does not
+        """
+
+        name_filter = MetricNameFilter(['Errors/all$'])
+        self.assertEqual(name_filter.exact_names, frozenset())
+        self.assertFalse(name_filter.match('Errors/all\nx'))
+        if newrelic.re2 is None:
+            self.assertTrue(name_filter.match('Errors/all\n'))
+
+        name_filter = MetricNameFilter([r'Errors/all\Z'])
+        self.assertEqual(name_filter.exact_names, frozenset(['Errors/all']))
+        self.assertIsNone(name_filter.regex)
+        self.assertFalse(name_filter.match('Errors/all\n'))
+        self.assertIsNone(re.match(r'Errors/all\Z', 'Errors/all\n'))
+
+class TestCompileRegexUnion(unittest.TestCase):
+
+    def test_empty(self):
+        self.assertIsNone(compile_regex_union([]))
+
+    def test_backreferences_are_kept(self):
+        regex = compile_regex_union(['(a)b', r'(c)\1'])
+        self.assertIsInstance(regex, RegexList)
+        self.assertIsNotNone(regex.match('cc'))
+        self.assertIsNotNone(regex.match('ab'))
+        self.assertIsNone(regex.match('ca'))
+
+    def test_duplicate_group_names(self):
+        regex = compile_regex_union(['(?P<x>a)', '(?P<x>b)'])
+        self.assertIsNotNone(regex.match('b'))
+
+    def test_inline_flags_are_not_global(self):
+        regex = compile_regex_union(['(?i)abc', 'xyz'])
+        self.assertIsNotNone(regex.match('ABC'))
+        self.assertIsNone(regex.match('XYZ'))
+
+class FakeConfig(object):
+    """
+    The configuration items used by the metric names cache
+    """
+
+    def __init__(self, cache_directory):
+        self.cache_directory = cache_directory
+
+class TestMetricNamesCacheFile(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.filepath = os.path.join(self.tmpdir, 'hash.names')
+        # no __init__(): the command is not configured from a file
+        self.command = NewRelicMetricRetrieverCommand.__new__(
+            NewRelicMetricRetrieverCommand)
+        self.command.config = FakeConfig(self.tmpdir)
+
+    def _load(self):
+        with open(self.filepath, 'rb') as contents:
+            return marshal.load(contents)
+
+    def test_concurrent_writers(self):
+        """
+        Tests that writers saving the same cache file at the same time each
+        use their own temporary file and leave a complete file behind
+        """
+
+        lists = [['name%d/%d' % (writer, i) for i in range(500)]
+                 for writer in range(4)]
+        errors = []
+
+        def _write(names):
+            try:
+                for _ in range(50):
+                    # pylint: disable=protected-access
+                    self.command._save_names(self.filepath, names)
+            except Exception as err: #pylint: disable=broad-except
+                errors.append(err)
+        threads = [threading.Thread(target=_write, args=(names, ))
+                   for names in lists]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertIn(self._load(), lists)
+        self.assertEqual(os.listdir(self.tmpdir), ['hash.names'])
+
+    def test_failed_write_removes_temporary_file(self):
+        # pylint: disable=protected-access
+        self.command._save_names(self.filepath, ['a', 'b'])
+        self.assertRaises(ValueError, self.command._save_names,
+                          self.filepath, [object()])
+        self.assertEqual(self._load(), ['a', 'b'])
+        self.assertEqual(os.listdir(self.tmpdir), ['hash.names'])
+
+class TestMetricNamesCacheLoad(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.filepath = os.path.join(self.tmpdir, 'hash.names')
+        self.addCleanup(NewRelicMetricRetrieverCommand.names_file_cache.pop,
+                        self.filepath, None)
+
+    def _write(self, names, file_stat=None):
+        """
+        Writes the names to the cache file (as another process would)
+        keeping the given file's times when file_stat is given
+        """
+
+        with open(self.filepath, 'wb') as contents:
+            marshal.dump(names, contents)
+        if file_stat is not None:
+            os.utime(self.filepath, (file_stat.st_atime, file_stat.st_mtime))
+
+    def _load(self):
+        # pylint: disable=protected-access
+        cached = NewRelicMetricRetrieverCommand._load_names_cached(
+            self.filepath)
+        return cached[1] if cached else None
+
+    def test_loaded_once(self):
+        self._write(['a', 'b'])
+        first = self._load()
+        self.assertEqual(first, ['a', 'b'])
+        self.assertIs(self._load(), first)
+
+    def test_rewritten_file_reloaded(self):
+        """
+        Tests that a cache file rewritten between calls is loaded again,
+        even when its size and modification time are unchanged
+        """
+
+        self._write(['a', 'b'])
+        self.assertEqual(self._load(), ['a', 'b'])
+
+        self._write(['c', 'd', 'e'])
+        self.assertEqual(self._load(), ['c', 'd', 'e'])
+
+        file_stat = os.stat(self.filepath)
+        self._write(['x', 'y', 'z'], file_stat)
+        self.assertEqual(os.path.getsize(self.filepath), file_stat.st_size)
+        self.assertEqual(self._load(), ['x', 'y', 'z'])
+
+    def test_deleted_file(self):
+        self._write(['a'])
+        self.assertEqual(self._load(), ['a'])
+        os.unlink(self.filepath)
+        self.assertIsNone(self._load())
+        self.assertNotIn(self.filepath,
+                         NewRelicMetricRetrieverCommand.names_file_cache)
+
+    def test_invalid_file(self):
+        with open(self.filepath, 'wb') as contents:
+            contents.write('not marshal data')
+        self.assertIsNone(self._load())
+        self._write({'a': 1})
+        self.assertIsNone(self._load())
+
+if __name__ == '__main__':
+    unittest.main()
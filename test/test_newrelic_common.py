@@ -0,0 +1,259 @@
+import calendar
+import datetime
+import logging
+import socket
+import sys
+import threading
+import unittest
+
+import mock
+import requests
+
+sys.path.append('..')
+from wavefront.newrelic_common import (MetricBatcher, NewRelicCommand,
+                                       _fast_iso_utc)
+
+def _http_error(status):
+    """
+    Creates an HTTPError for a response with the given HTTP status code
+    """
+
+    response = requests.models.Response()
+    response.status_code = status
+    return requests.exceptions.HTTPError('HTTP %d' % status,
+                                         response=response)
+
+class TestCallApi(unittest.TestCase):
+
+    def setUp(self):
+        # no __init__(): the command is not configured from a file
+        self.command = NewRelicCommand.__new__(NewRelicCommand)
+        self.command.logger = logging.getLogger('test')
+        self.command.config = None
+        patcher = mock.patch.object(NewRelicCommand, '_sleep_backoff')
+        self.sleep = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _call_api(self, error):
+        """
+        Calls call_api() with _call_api() raising the given error
+
+        Returns:
+        Tuple: the value returned by call_api() and the number of calls to
+        _call_api()
+        """
+
+        with mock.patch.object(self.command, '_call_api',
+                               side_effect=error) as call:
+            result = self.command.call_api('/v2/applications.json')
+        return (result, call.call_count)
+
+    def test_success(self):
+        with mock.patch.object(self.command, '_call_api',
+                               return_value=({'a': 1}, 'response')) as call:
+            self.assertEqual(self.command.call_api('/p'),
+                             ({'a': 1}, 'response'))
+        self.assertEqual(call.call_count, 1)
+        self.assertFalse(self.sleep.called)
+
+    def test_client_errors_not_retried(self):
+        """
+        Tests that 4xx errors (other than 429) fail on the first attempt
+        """
+
+        for status in (400, 401, 403, 404):
+            self.assertEqual(self._call_api(_http_error(status)),
+                             ((None, None), 1))
+
+    def test_server_errors_retried(self):
+        """
+        Tests that 5xx and 429 errors are retried 5 times in total
+        """
+
+        for status in (429, 500, 502, 503):
+            self.assertEqual(self._call_api(_http_error(status)),
+                             ((None, None), 5))
+
+    def test_connection_errors_retried(self):
+        for error in (requests.exceptions.ConnectionError(),
+                      requests.exceptions.Timeout(),
+                      requests.exceptions.ChunkedEncodingError()):
+            self.assertEqual(self._call_api(error), ((None, None), 5))
+
+    def test_retry_then_success(self):
+        with mock.patch.object(
+                self.command, '_call_api',
+                side_effect=[requests.exceptions.Timeout(),
+                             _http_error(503), ({}, 'response')]) as call:
+            self.assertEqual(self.command.call_api('/p'), ({}, 'response'))
+        self.assertEqual(call.call_count, 3)
+        self.assertEqual([args[0][0] for args in self.sleep.call_args_list],
+                         [0, 1])
+
+    def test_invalid_response_not_retried(self):
+        """
+        Tests that invalid requests and responses (e.g., not JSON) fail on
+        the first attempt
+        """
+
+        for error in (ValueError('No JSON object could be decoded'),
+                      requests.exceptions.InvalidURL()):
+            self.assertEqual(self._call_api(error), ((None, None), 1))
+
+class TestFastIsoUtc(unittest.TestCase):
+
+    def _strptime(self, timestamp):
+        parsed = datetime.datetime.strptime(timestamp,
+                                            '%Y-%m-%dT%H:%M:%S+00:00')
+        return calendar.timegm(parsed.timetuple())
+
+    def test_valid(self):
+        """
+        Tests that valid timestamps convert the same as with strptime()
+        """
+
+        for timestamp in ('2016-04-27T13:30:15+00:00',
+                          '1970-01-01T00:00:00+00:00',
+                          '2016-02-29T23:59:59+00:00',
+                          '1999-12-31T23:59:59+00:00',
+                          '2038-01-19T03:14:08+00:00'):
+            self.assertEqual(_fast_iso_utc(timestamp),
+                             self._strptime(timestamp), timestamp)
+
+    def test_invalid_date_time(self):
+        """
+        Tests that out of range fields are rejected (as strptime() does)
+        """
+
+        for timestamp in ('2016-13-01T00:00:00+00:00',
+                          '2016-00-01T00:00:00+00:00',
+                          '2016-04-31T00:00:00+00:00',
+                          '2015-02-29T00:00:00+00:00',
+                          '2016-04-00T00:00:00+00:00',
+                          '2016-04-27T24:00:00+00:00',
+                          '2016-04-27T13:60:00+00:00',
+                          '2016-04-27T13:30:61+00:00',
+                          '0000-01-01T00:00:00+00:00'):
+            self.assertIsNone(_fast_iso_utc(timestamp), timestamp)
+            self.assertRaises(ValueError, self._strptime, timestamp)
+
+    def test_other_formats(self):
+        for timestamp in ('2016-04-27T13:30:15Z',
+                          '2016-04-27T13:30:15-07:00',
+                          '2016-04-27 13:30:15+00:00',
+                          '2016-4-27T13:30:15+00:00',
+                          '2016-04-27T13:30:15+00:00\n',
+                          '2016-04-27T13:30:15.123+00:00',
+                          ''):
+            self.assertIsNone(_fast_iso_utc(timestamp), repr(timestamp))
+
+class FakeWriter(object):
+    """
+    Metrics writer that records the metrics written.  The first (failures)
+    calls to flush() raise socket.error (the buffered metrics are kept)
+    """
+
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.buffer = []
+        self.sent = []
+        self.flushes = 0
+        self.stopped = False
+
+    def transmit_metrics(self, metrics, timestamp, source, point_tags):
+        for name, value in metrics:
+            self.buffer.append((name, value, timestamp, source, point_tags))
+
+    def flush(self):
+        self.flushes = self.flushes + 1
+        if self.failures > 0:
+            self.failures = self.failures - 1
+            raise socket.error('connection reset')
+        self.sent.extend(self.buffer)
+        self.buffer = []
+
+    def stop(self):
+        self.stopped = True
+
+class TestMetricBatcher(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(NewRelicCommand, '_sleep_backoff')
+        self.sleep = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.logger = logging.getLogger('test')
+
+    def test_close_sends_all(self):
+        """
+        Tests that all metrics written from several threads are sent (in
+        batches) by the time close() returns
+        """
+
+        writer = FakeWriter()
+        batcher = MetricBatcher(writer, self.logger, max_metrics=7)
+
+        def _write(thread_id):
+            for i in range(100):
+                batcher.transmit_metric('m%d' % i, i, 100, 's%d' % thread_id,
+                                        None)
+        threads = [threading.Thread(target=_write, args=(i, ))
+                   for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        batcher.transmit_metrics([('a', 1), ('b', 2)], 200, 'x', {'k': 'v'})
+        batcher.transmit_metrics([], 200, 'x', None)
+        batcher.close()
+
+        self.assertTrue(writer.stopped)
+        self.assertFalse(batcher.thread.is_alive())
+        self.assertEqual(len(writer.sent), 402)
+        self.assertEqual(len(set(metric[:4] for metric in writer.sent)), 402)
+        self.assertIn(('b', 2, 200, 'x', {'k': 'v'}), writer.sent)
+        self.assertGreaterEqual(writer.flushes, 402 // 7)
+
+    def test_failed_send_retried(self):
+        """
+        Tests that a failed flush is retried without writing the batch to
+        the writer again
+        """
+
+        writer = FakeWriter(failures=2)
+        batcher = MetricBatcher(writer, self.logger)
+        batcher.transmit_metrics([('a', 1), ('b', 2)], 100, 's', None)
+        batcher.close()
+
+        self.assertEqual(writer.sent, [('a', 1, 100, 's', None),
+                                       ('b', 2, 100, 's', None)])
+        self.assertEqual(writer.flushes, 3)
+        self.assertEqual(self.sleep.call_count, 2)
+
+    def test_failed_send_gives_up(self):
+        writer = FakeWriter(failures=100)
+        batcher = MetricBatcher(writer, self.logger)
+        batcher.transmit_metric('a', 1, 100, 's', None)
+        batcher.close()
+
+        self.assertEqual(writer.sent, [])
+        self.assertEqual(writer.flushes, 5)
+        self.assertTrue(writer.stopped)
+
+    def test_close_thread_not_running(self):
+        """
+        Tests that writes and close() do not block once the background
+        thread has died
+        """
+
+        writer = FakeWriter()
+        batcher = MetricBatcher(writer, self.logger, max_queued=1)
+        batcher.close()
+        batcher.transmit_metric('a', 1, 100, 's', None)
+        batcher.transmit_metric('b', 2, 100, 's', None)
+        batcher.close()
+
+        self.assertEqual(writer.sent, [])
+        self.assertTrue(writer.stopped)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,9 +1,31 @@
-import mock
+from collections import namedtuple
+import hashlib
+import os
+import shutil
 import sys
+import tempfile
 import unittest
 
+import mock
+
 sys.path.append('..')
-from wavefront.system_checker import SystemCheckerCommand
+from wavefront import utils
+from wavefront.system_checker import (SystemCheckerCommand,
+                                      SystemCheckerConfiguration)
+
+CONFIG = """[global]
+cache_dir=%(tmpdir)s/cache
+
+[find_files]
+paths=%(tmpdir)s/find
+patterns=core.*
+event_names=core
+
+[file_changes]
+files=%(tmpdir)s/watched
+event_names=watched
+%(extra)s
+"""
 
 def literal(**kw):
     return namedtuple('literal', kw)(**kw)
@@ -26,6 +48,123 @@ class TestSystemCheckerCommand(unittest.TestCase):
         m = mock.mock_open(read_data='[global]\n')
         with mock.patch('__main__.open', m, create=True):
             cmd.execute(args)
-        
+
+# pylint: disable=protected-access
+class TestFileHashing(unittest.TestCase):
+
+    def setUp(self):
+        # ConfigParser lowercases option names (the paths in the md5 hashes
+        # file) so the directory name is kept lowercase
+        self.tmpdir = os.path.join(tempfile.gettempdir(),
+                                   'system_checker_test_%d' % os.getpid())
+        os.mkdir(self.tmpdir)
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        os.mkdir(os.path.join(self.tmpdir, 'find'))
+        self.watched = os.path.join(self.tmpdir, 'watched')
+        self._write(self.watched, 'original\n')
+        self.core = os.path.join(self.tmpdir, 'find', 'core.1')
+        self._write(self.core, 'core dump\n')
+        self.events = []
+        patcher = mock.patch.object(utils, 'hashfile',
+                                    side_effect=utils.hashfile)
+        self.hashfile = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @staticmethod
+    def _write(path, contents):
+        with open(path, 'w') as afile:
+            afile.write(contents)
+
+    def _hashed(self):
+        """
+        Returns the paths hashed since the last call
+        """
+
+        paths = [args[0][0] for args in self.hashfile.call_args_list]
+        self.hashfile.reset_mock()
+        return sorted(paths)
+
+    def _command(self, extra=''):
+        """
+        Creates a command with the configuration read from the test
+        directory (as on each run of the command)
+        """
+
+        config_path = os.path.join(self.tmpdir, 'test.conf')
+        self._write(config_path, CONFIG % {'tmpdir': self.tmpdir,
+                                           'extra': extra})
+        cmd = SystemCheckerCommand()
+        cmd.config = SystemCheckerConfiguration(config_path)
+        cmd._send_event = self._send_event
+        return cmd
+
+    def _send_event(self, name, *_):
+        self.events.append(name)
+        return True
+
+    def _touch_unmodified(self, path, contents):
+        """
+        Changes the file without changing its size or modification time
+        """
+
+        file_stat = os.stat(path)
+        self._write(path, contents)
+        os.utime(path, (file_stat.st_atime, file_stat.st_mtime))
+
+    def test_changed_file_always_hashed(self):
+        """
+        Tests that watched files are hashed on every run by default, so a
+        change that keeps the modification time and size is detected
+        """
+
+        self._command()._execute()
+        self.assertEqual(self._hashed(), [self.core, self.watched])
+        self.assertEqual(self.events, ['core found'])
+
+        self._command()._execute()
+        self.assertEqual(self._hashed(), [self.core, self.watched])
+
+        self._touch_unmodified(self.watched, 'changed!\n')
+        self._command()._execute()
+        self.assertIn(self.watched, self._hashed())
+        self.assertEqual(self.events, ['core found',
+                                       'File Change (%s)' % self.watched])
+
+    def test_skip_unmodified(self):
+        """
+        Tests that with skip_unmodified enabled, files are only hashed again
+        when their modification time or size changed
+        """
+
+        self._command('skip_unmodified=true')._execute()
+        self.assertIn(self.watched, self._hashed())
+
+        self._command('skip_unmodified=true')._execute()
+        self.assertNotIn(self.watched, self._hashed())
+
+        self._write(self.watched, 'changed and longer\n')
+        self._command('skip_unmodified=true')._execute()
+        self.assertIn(self.watched, self._hashed())
+        self.assertEqual(self.events[-1], 'File Change (%s)' % self.watched)
+
+    def test_found_file_hash_reused(self):
+        """
+        Tests that a found file is not hashed again by the same command
+        until its inode, modification time or size changes
+        """
+
+        cmd = self._command()
+        cmd._check_for_files_matching()
+        cmd._check_for_files_matching()
+        self.assertEqual(self._hashed(), [self.core])
+        self.assertEqual(self.events, ['core found'])
+        self.assertEqual(cmd.config.found_file_hashes[self.core][1],
+                         hashlib.md5('core dump\n').hexdigest())
+
+        self._write(self.core, 'another core dump\n')
+        cmd._check_for_files_matching()
+        self.assertEqual(self._hashed(), [self.core])
+        self.assertEqual(self.events, ['core found', 'core found'])
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,213 @@
+import datetime
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.append('..')
+import dateutil.tz
+
+from wavefront import utils
+
+CONFIG = """[DEFAULT]
+shared=from_default
+
+[main]
+name=value
+flag=yes
+empty=
+items= a, b ,c
+start=2016-04-27T13:30:15
+path=%(shared)s/x
+
+[other]
+name=other_value
+off=0
+bad=maybe
+"""
+
+class TestHashFile(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def _write(self, data):
+        path = os.path.join(self.tmpdir, 'file')
+        with open(path, 'wb') as afile:
+            afile.write(data)
+        return path
+
+    def test_block_boundaries(self):
+        """
+        Tests that files smaller than, the same size as and larger than the
+        block size hash the same as the whole contents
+        """
+
+        blocksize = 64
+        for size in (0, 1, blocksize - 1, blocksize, blocksize + 1,
+                     2 * blocksize, 3 * blocksize + 7):
+            data = os.urandom(size)
+            path = self._write(data)
+            self.assertEqual(
+                utils.hashfile(path, hashlib.md5(), blocksize),
+                hashlib.md5(data).hexdigest(), 'size %d' % size)
+
+    def test_default_blocksize(self):
+        data = os.urandom((1 << 20) + 3)
+        path = self._write(data)
+        self.assertEqual(utils.hashfile(path, hashlib.sha1()),
+                         hashlib.sha1(data).hexdigest())
+
+    def test_buffer_reused_with_other_blocksize(self):
+        """
+        Tests that calls with a different block size do not reuse a buffer
+        of the wrong size
+        """
+
+        data = os.urandom(1000)
+        path = self._write(data)
+        for blocksize in (16, 256, 16, 4096):
+            self.assertEqual(
+                utils.hashfile(path, hashlib.md5(), blocksize),
+                hashlib.md5(data).hexdigest())
+
+    def test_missing_file(self):
+        self.assertRaises(IOError, utils.hashfile,
+                          os.path.join(self.tmpdir, 'missing'), hashlib.md5())
+
+class TestConfiguration(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, 'test.conf')
+        self._write(CONFIG)
+
+    def _write(self, contents):
+        with open(self.path, 'w') as afile:
+            afile.write(contents)
+
+    def test_get(self):
+        config = utils.Configuration(self.path)
+        self.assertTrue(config.has_section('main'))
+        self.assertFalse(config.has_section('missing'))
+        self.assertEqual(config.get('main', 'name', None), 'value')
+        self.assertEqual(config.get('main', 'missing', 'def'), 'def')
+        self.assertEqual(config.get('missing', 'name', 'def'), 'def')
+        self.assertEqual(config.get('main', 'shared', None), 'from_default')
+
+    def test_fallback_section(self):
+        """
+        Tests that the default section is used only when the key is not in
+        the section; an empty value is a value
+        """
+
+        config = utils.Configuration(self.path)
+        self.assertEqual(config.get('other', 'name', None, 'main'),
+                         'other_value')
+        self.assertEqual(config.get('other', 'flag', None, 'main'), 'yes')
+        self.assertEqual(config.get('missing', 'flag', None, 'main'), 'yes')
+        self.assertEqual(config.get('other', 'empty', None, 'main'), '')
+        self.assertEqual(config.get('main', 'missing', 'def', 'other'), 'def')
+        self.assertTrue(config.getboolean('other', 'flag', False, 'main'))
+
+    def test_empty_fallback_section_name(self):
+        """
+        Tests that a fallback section named '' is looked up (not skipped)
+        """
+
+        config = utils.Configuration(self.path)
+        config.set('', 'only_here', 'x')
+        self.assertEqual(config.get('main', 'only_here', None, ''), 'x')
+
+    def test_getboolean(self):
+        config = utils.Configuration(self.path)
+        self.assertTrue(config.getboolean('main', 'flag', False))
+        self.assertFalse(config.getboolean('other', 'off', True))
+        self.assertTrue(config.getboolean('main', 'missing', True))
+        self.assertRaises(ValueError, config.getboolean, 'other', 'bad', True)
+
+    def test_getlist(self):
+        config = utils.Configuration(self.path)
+        self.assertEqual(config.getlist('main', 'items', None),
+                         ['a', ' b ', 'c'])
+        self.assertEqual(config.getlist('main', 'items', None, trim=True),
+                         ['a', 'b', 'c'])
+        self.assertEqual(config.getlist('main', 'missing', ['x ']),
+                         ['x '])
+        self.assertEqual(config.getlist('main', 'missing', ['x '],
+                                        trim=True), ['x'])
+        self.assertEqual(config.getlist('main', 'name', None, delimiter='l'),
+                         ['va', 'ue'])
+
+    def test_getdate(self):
+        config = utils.Configuration(self.path)
+        self.assertEqual(
+            config.getdate('main', 'start', None),
+            datetime.datetime(2016, 4, 27, 13, 30, 15,
+                              tzinfo=dateutil.tz.tzutc()))
+        self.assertEqual(config.getdate('other', 'start', None, 'main'),
+                         config.getdate('main', 'start', None))
+        self.assertIsNone(config.getdate('main', 'empty', None))
+        self.assertEqual(config.getdate('main', 'missing', 'def'), 'def')
+
+    def test_interpolate(self):
+        """
+        Tests that values are returned as is unless interpolation is enabled
+        """
+
+        self.assertEqual(
+            utils.Configuration(self.path).get('main', 'path', None),
+            '%(shared)s/x')
+        self.assertEqual(
+            utils.Configuration(self.path, interpolate=True).get(
+                'main', 'path', None),
+            'from_default/x')
+
+    def test_cached_copies_independent(self):
+        """
+        Tests that instances read from the cache do not share changes
+        """
+
+        first = utils.Configuration(self.path)
+        first.set('main', 'name', 'changed')
+        first.set('new', 'key', 'value')
+        second = utils.Configuration(self.path)
+        self.assertEqual(second.get('main', 'name', None), 'value')
+        self.assertFalse(second.has_section('new'))
+        self.assertEqual(second.get('main', 'shared', None), 'from_default')
+
+    def test_changed_file_reread(self):
+        """
+        Tests that a file changed without changing its size or modification
+        time is read again
+        """
+
+        config = utils.Configuration(self.path)
+        self.assertEqual(config.get('main', 'name', None), 'value')
+        file_stat = os.stat(self.path)
+        self._write(CONFIG.replace('name=value', 'name=VALUE'))
+        os.utime(self.path, (file_stat.st_atime, file_stat.st_mtime))
+        self.assertEqual(os.path.getsize(self.path), file_stat.st_size)
+
+        config = utils.Configuration(self.path)
+        self.assertEqual(config.get('main', 'name', None), 'VALUE')
+
+    def test_save(self):
+        config = utils.Configuration(self.path)
+        config.set('main', 'name', 'saved')
+        config.save()
+        self.assertEqual(
+            utils.Configuration(self.path).get('main', 'name', None), 'saved')
+
+    def test_missing_file(self):
+        path = os.path.join(self.tmpdir, 'missing.conf')
+        self.assertRaises(ValueError, utils.Configuration, path)
+        config = utils.Configuration(path, True)
+        self.assertEqual(config.get('main', 'name', 'def'), 'def')
+
+if __name__ == '__main__':
+    unittest.main()
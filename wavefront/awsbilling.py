@@ -18,6 +18,7 @@ import dateutil
 
 from wavefront.aws_common import AwsBaseMetricsCommand, AwsBaseMetricsConfiguration
 from wavefront import utils
+from wavefront.metrics_writer import prepare_tags
 
 #pylint: disable=too-few-public-methods
 #pylint: disable=too-many-instance-attributes
@@ -443,6 +444,7 @@ class AwsBillingMetricsCommand(AwsBaseMetricsCommand):
             duration = 0
 
         # metric and value
+        tags = prepare_tags(point_tags)
         for header, metric_name in config.metrics.iteritems():
             if config.namespace:
                 metric = config.namespace + '.' + metric_name
@@ -455,9 +457,9 @@ class AwsBillingMetricsCommand(AwsBaseMetricsCommand):
 
             # send the metric to the proxy
             self.proxy.transmit_metric(metric, value, long(tstamp),
-                                       source, point_tags)
+                                       source, tags)
             if duration:
                 self.proxy.transmit_metric(metric + '.duration',
                                            duration, long(tstamp),
-                                           source, point_tags)
+                                           source, tags)
 
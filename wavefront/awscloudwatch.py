@@ -31,6 +31,7 @@ import dateutil
 
 from wavefront.aws_common import AwsBaseMetricsCommand, AwsBaseMetricsConfiguration
 from wavefront import utils
+from wavefront.metrics_writer import prepare_tags
 
 # Configuration for metrics that should be retrieved is contained in this
 # configuration in a "metrics" key.  This is a dictionary
@@ -329,6 +330,12 @@ class AwsCloudwatchMetricsCommand(AwsBaseMetricsCommand):
                 self.logger.warning('Source is not found in %s', str(metric))
                 continue
 
+            # remove point tags that we don't need for WF and render the
+            # remaining ones once for all of this metric's data points
+            if 'Namespace' in point_tags:
+                del point_tags['Namespace']
+            tags = prepare_tags(point_tags)
+
             curr_start = start
             if (end - curr_start).total_seconds() > 86400:
                 curr_end = curr_start + datetime.timedelta(days=1)
@@ -359,17 +366,13 @@ class AwsCloudwatchMetricsCommand(AwsBaseMetricsCommand):
                         else:
                             full_metric_name = metric_name + '.' + short_name
 
-                        # remove point tags that we don't need for WF
-                        if 'Namespace' in point_tags:
-                            del point_tags['Namespace']
-
                         # send the metric to the proxy
                         tstamp = int(utils.unix_time_seconds(stat['Timestamp']))
                         self.proxy.transmit_metric(full_metric_name,
                                                    stat[statname],
                                                    tstamp,
                                                    source,
-                                                   point_tags)
+                                                   tags)
 
                 curr_start = curr_end
                 if (end - curr_start).total_seconds() > 86400:
@@ -1,21 +1,99 @@
 """
 This module contains the classes that write metrics to their final endpoint.
 """
+import os
 import socket
+import stat
+import sys
 import threading
 
+def _escape_tag(value):
+    """
+    Escapes backslashes and double quotes in a tag key or value so it can be
+    safely wrapped in double quotes on the metric line.  Backslashes are
+    escaped first so that a trailing backslash cannot escape the closing quote.
+    """
+
+    return ('%s' % (value, )).replace('\\', '\\\\').replace('"', '\\"')
+
+def prepare_tags(point_tags):
+    """
+    Renders the point tags dictionary into the tag portion of a metric line
+    (e.g., ' "k1"="v1" "k2"="v2"').  Keys and values are escaped here once so
+    that callers sending many points with the same tags can store the result
+    and pass it to transmit_metric() as point_tags instead of the dictionary.
+
+    Arguments:
+    point_tags - dictionary of key/value pairs (or None)
+
+    Returns:
+    The tag string (empty string when there are no tags)
+    """
+
+    if not point_tags:
+        return ''
+    return ''.join([' "%s"="%s"' % (_escape_tag(key), _escape_tag(value))
+                    for key, value in point_tags.iteritems()])
+
+def _get_tags_suffix(point_tags):
+    """
+    Returns the tag string for the given point tags.  point_tags may already
+    be a string returned from prepare_tags().
+    """
+
+    if isinstance(point_tags, basestring):
+        return point_tags
+    return prepare_tags(point_tags)
+
+def _is_stdout_null_sink():
+    """
+    Checks to see if stdout is redirected to the null device (/dev/null)
+
+    Returns:
+    True if stdout is the null device; False o/w (or if it cannot be
+    determined)
+    """
+
+    try:
+        stdout_stat = os.fstat(sys.stdout.fileno())
+        null_stat = os.stat(os.devnull)
+    except (AttributeError, ValueError, IOError, OSError):
+        return False
+
+    return (stat.S_ISCHR(stdout_stat.st_mode) and
+            stdout_stat.st_rdev == null_stat.st_rdev)
+
 #pylint: disable=too-many-arguments
 class MetricsWriter(object):
     """
     Writer for managing the socket connection to metrics receiver.
+
+    When buffer_size is set, lines are collected in memory and sent with a
+    single sendall() once at least buffer_size bytes are pending (and on
+    flush() / stop()).  A buffered writer must only be used by one thread.
     """
 
-    def __init__(self, host, port, dry_run=False):
+    def __init__(self, host, port, dry_run=False, buffer_size=0):
         super(MetricsWriter, self).__init__()
         self.is_dry_run = dry_run
         self.host = host
         self.port = port
         self.sock = None
+        self.buffer_size = buffer_size
+        self._buffer = []
+        self._buffered_bytes = 0
+        self._emit_enabled = True
+
+    def enable(self, enabled=True):
+        """
+        Enables or disables emitting metrics.  When disabled,
+        transmit_metric() returns immediately without generating the line.
+
+        Arguments:
+        enabled - True to emit metrics; False to discard them
+        """
+
+        self._emit_enabled = enabled
 
     def transmit_metric(self, name, value, timestamp, source, point_tags):
         """
@@ -26,11 +104,16 @@ class MetricsWriter(object):
         value - the numeric value for this metric
         timestamp - the timestamp for this metric
         source - this metric's host or source name
-        point_tags - dictionary of key/value pairs
+        point_tags - dictionary of key/value pairs or the string returned
+                     from prepare_tags()
         """
 
-        line = self._generate_line(name, value, timestamp, source, point_tags)
+        if not self._emit_enabled:
+            return
+
         if self.is_dry_run:
+            line = self._generate_line(
+                name, value, timestamp, source, point_tags)
             thread_id = hex(threading.current_thread().ident)
             # command line mode you want to see this in stdout
             # in daemon mode you want to see this in a log
@@ -38,9 +121,128 @@ class MetricsWriter(object):
             print '[{} {}:{}] {}'.format(thread_id, self.host, self.port, line)
 
         else:
-            self.sock.sendall('%s\n' % line)
+            # the line (including its newline) is built in a single call
+            line = self._generate_line(
+                name, value, timestamp, source, point_tags, '\n')
+            if self.buffer_size:
+                self._buffer_data(line)
+            else:
+                self._send(line)
+
+    def transmit_metrics(self, metrics, timestamp, source, point_tags):
+        """
+        Transmit several metrics sharing the same timestamp, source and point
+        tags to the proxy.  All lines are sent with a single write (or added
+        to the buffer at once).
 
-    def _generate_line(self, name, value, timestamp, source, point_tags):
+        Arguments:
+        metrics - list of (name, value) tuples
+        timestamp - the timestamp for these metrics
+        source - the host or source name of these metrics
+        point_tags - dictionary of key/value pairs or the string returned
+                     from prepare_tags()
+        """
+
+        if not self._emit_enabled or not metrics:
+            return
+
+        if self.is_dry_run:
+            for name, value in metrics:
+                self.transmit_metric(name, value, timestamp, source,
+                                     point_tags)
+            return
+
+        generate_line = self._generate_line
+        data = ''.join([generate_line(name, value, timestamp, source,
+                                      point_tags, '\n')
+                        for name, value in metrics])
+        if self.buffer_size:
+            self._buffer_data(data)
+        else:
+            self._send(data)
+
+    #pylint: disable=bare-except
+    def _buffer_data(self, data):
+        """
+        Adds the line(s) to the buffer and flushes the buffer when it is full.
+        If the flush fails, the given data is removed from the buffer again
+        (the caller sees the error and may retry it) while the lines buffered
+        by earlier calls are kept for the next flush.
+
+        Arguments:
+        data - the line(s) to buffer (including the newline)
+        """
+
+        self._buffer.append(data)
+        self._buffered_bytes = self._buffered_bytes + len(data)
+        if self._buffered_bytes >= self.buffer_size:
+            try:
+                self.flush()
+            except:
+                self._buffer.pop()
+                self._buffered_bytes = self._buffered_bytes - len(data)
+                raise
+
+    def flush(self):
+        """
+        Sends any buffered lines to the socket.  The buffer is only cleared
+        once they have been sent.
+        """
+
+        if self._buffer:
+            self._send(''.join(self._buffer))
+            self._buffer = []
+            self._buffered_bytes = 0
+
+    def _send(self, data):
+        """
+        Sends the data to the socket.  When sending fails the socket is
+        closed and the next send opens a new connection, so a restarted
+        proxy is picked up again.
+
+        Arguments:
+        data - the line(s) to send
+        """
+
+        if self.sock is None:
+            self._connect()
+        try:
+            self.sock.sendall(data)
+        except socket.error:
+            self._close_socket()
+            raise
+
+    def _connect(self):
+        """
+        Opens the socket connection
+        """
+
+        sock = socket.socket()
+        sock.settimeout(10.0)
+        try:
+            sock.connect((self.host, self.port))
+        except socket.error:
+            sock.close()
+            raise
+        self.sock = sock
+
+    def _close_socket(self):
+        """
+        Shuts down and closes the socket (if open)
+        """
+
+        sock = self.sock
+        self.sock = None
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            sock.close()
+
+    #pylint: disable=unused-argument
+    def _generate_line(self, name, value, timestamp, source, point_tags,
+                       terminator=''):
         """
         This should be overridden by the derived classes.  Generates the
         metric put line for the writer.
@@ -51,6 +253,7 @@ class MetricsWriter(object):
         timestamp - the timestamp for this metric
         source - this metric's host or source name
         point_tags - dictionary of key/value pairs
+        terminator - string to append to the end of the line (e.g., newline)
         """
 
         pass
@@ -60,19 +263,24 @@ class MetricsWriter(object):
         Connect and open the socket
         """
 
-        if not self.is_dry_run:
-            self.sock = socket.socket()
-            self.sock.settimeout(10.0)
-            self.sock.connect((self.host, self.port))
+        if self.is_dry_run:
+            # nobody will see the dry run output so don't bother with it
+            if _is_stdout_null_sink():
+                self.enable(False)
+
+        else:
+            self._connect()
 
     def stop(self):
         """
         Stop and shutdown the open socket
         """
 
-        if self.sock is not None and not self.is_dry_run:
-            self.sock.shutdown(socket.SHUT_RDWR)
-            self.sock.close()
+        if (self.sock is not None or self._buffer) and not self.is_dry_run:
+            try:
+                self.flush()
+            finally:
+                self._close_socket()
 
     def __enter__(self):
         """
@@ -95,35 +303,34 @@ class WavefrontMetricsWriter(MetricsWriter):
     This is the metrics writer for the Wavefront proxy format.
     """
 
-    def __init__(self, host, port, dry_run=False):
-        super(WavefrontMetricsWriter, self).__init__(host, port, dry_run)
+    def __init__(self, host, port, dry_run=False, buffer_size=0):
+        super(WavefrontMetricsWriter, self).__init__(
+            host, port, dry_run, buffer_size)
 
-    def _generate_line(self, name, value, timestamp, source, point_tags):
+    def _generate_line(self, name, value, timestamp, source, point_tags,
+                       terminator=''):
         """
         Generates the line in the Wavefront proxy format.
         """
-        line = '{} {} {} source="{}"'.format(
-            name, value, long(timestamp), source)
-        if point_tags is not None:
-            for tag_key, tag_value in point_tags.iteritems():
-                line = line + ' "{}"="{}"'.format(tag_key, tag_value)
-        return line
+        return '{} {} {} source="{}"{}{}'.format(
+            name, value, long(timestamp), source, _get_tags_suffix(point_tags),
+            terminator)
 
 class OpenTSDBMetricsWriter(MetricsWriter):
     """
     This is the metrics writer for the OpenTSDB format.
     """
 
-    def __init__(self, host, port, dry_run=False):
-        super(OpenTSDBMetricsWriter, self).__init__(host, port, dry_run)
+    def __init__(self, host, port, dry_run=False, buffer_size=0):
+        super(OpenTSDBMetricsWriter, self).__init__(
+            host, port, dry_run, buffer_size)
 
-    def _generate_line(self, name, value, timestamp, source, point_tags):
+    def _generate_line(self, name, value, timestamp, source, point_tags,
+                       terminator=''):
         """
         Generates the line in the OpenTSDB format.
         put <metric> <timestamp> <value> <tagk1=tagv1[ tagk2=tagv2 ...]
         """
-        line = 'put {} {} {} host="{}"'.format(name, timestamp, value, source)
-        if point_tags is not None:
-            for tag_key, tag_value in point_tags.iteritems():
-                line = line + ' "{}"="{}"'.format(tag_key, tag_value)
-        return line
+        return 'put {} {} {} host="{}"{}{}'.format(
+            name, timestamp, value, source, _get_tags_suffix(point_tags),
+            terminator)
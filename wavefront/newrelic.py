@@ -6,19 +6,30 @@ more details on configuration.
 
 import ConfigParser
 import datetime
+import decimal
+import functools
 import hashlib
-import json
-import numbers
+import marshal
 import os
 import os.path
 import re
+import tempfile
+import threading
 import time
 
 import logging.config
+from multiprocessing.pool import ThreadPool
 import dateutil.parser
 
-from wavefront.utils import parallel_process_and_wait
+# RE2 (google-re2 or pyre2) matches in linear time regardless of the pattern.
+# It is optional; the standard library's re module is used when missing.
+try:
+    import re2
+except ImportError:
+    re2 = None
+
 from wavefront import command, utils
+from wavefront.metrics_writer import prepare_tags
 from wavefront.newrelic_common import NewRelicCommand
 
 # default number of metric names to include with each GetMetricData
@@ -28,6 +39,163 @@ DEFAULT_MAX_METRIC_NAME_COUNT = 25
 # default location for the configuration file.
 DEFAULT_CONFIG_FILE_PATH = '/opt/wavefront/etc/wavefront-collector-newrelic.conf'
 
+# types of values returned by the API that are sent as-is (the json modules
+# only return int, long and float for numbers; ijson returns Decimal)
+NUMERIC_TYPES = (int, long, float, decimal.Decimal)
+
+# characters that make a filter expression a regular expression rather than
+# a literal metric name
+REGEX_SPECIAL_CHARS = re.compile(r'[.^$*+?{}\[\]\\|()]')
+
+#pylint: disable=too-few-public-methods
+class RegexList(object):
+    """
+    Separately compiled regular expressions with the same match() interface
+    as a compiled regular expression: match() returns the first pattern's
+    match object or None if no pattern matches.
+    """
+
+    def __init__(self, regexes):
+        self.regexes = regexes
+
+    def match(self, name):
+        """
+        Matches the name against each regular expression (re.match())
+
+        Arguments:
+        name - the string to match
+
+        Returns:
+        The first match object or None
+        """
+
+        for regex in self.regexes:
+            matched = regex.match(name)
+            if matched is not None:
+                return matched
+        return None
+
+def compile_regex_union(patterns):
+    """
+    Compiles the list of regular expressions into a single regular expression
+    that matches when any one of the patterns matches.  Patterns with groups
+    (whose numbers, names and backreferences would clash once joined) or
+    inline flags (which would apply to the whole union) are not joined; a
+    RegexList of the separately compiled patterns is returned instead.
+
+    Arguments:
+    patterns - list of regular expression strings
+
+    Returns:
+    The compiled regular expression (or RegexList) or None if patterns is
+    empty
+    """
+
+    if not patterns:
+        return None
+
+    default_flags = re.compile('').flags
+    compiled = [re.compile(pattern) for pattern in patterns]
+    if any(regex.groups or regex.flags != default_flags
+           for regex in compiled):
+        return RegexList(compiled)
+
+    regex = '|'.join(['(?:%s)' % (pattern) for pattern in patterns])
+    if re2:
+        try:
+            return re2.compile(regex)
+        except re2.error:
+            # RE2 does not support some syntax (backreferences, lookarounds)
+            pass
+    try:
+        return re.compile(regex)
+    except re.error:
+        return RegexList(compiled)
+
+def get_path_hash(path):
+    """
+    Gets the (MD5) hash of the given API path used to name its cache file
+
+    Arguments:
+    path - the URL path
+
+    Returns:
+    The hex digest string
+    """
+
+    return hashlib.md5(path.encode('utf8')).hexdigest()
+
+#pylint: disable=too-few-public-methods
+class MetricNameFilter(object):
+    """
+    Matches metric names against a list of regular expressions with the
+    same semantics as re.match() (anchored at the start of the name).
+    Expressions without any special characters are literal name prefixes
+    and are checked with str.startswith(); "literal\\Z" expressions are
+    checked with a set lookup.  Only the remaining expressions go through
+    the regular expression engine ("literal$" does too since $ also matches
+    before a trailing newline).
+    """
+
+    def __init__(self, patterns):
+        exact_names = []
+        prefixes = []
+        regexes = []
+        for pattern in patterns:
+            if not REGEX_SPECIAL_CHARS.search(pattern):
+                prefixes.append(pattern)
+            elif (pattern.endswith(r'\Z') and
+                  not REGEX_SPECIAL_CHARS.search(pattern[:-2])):
+                exact_names.append(pattern[:-2])
+            else:
+                regexes.append(pattern)
+
+        self.exact_names = frozenset(exact_names)
+        self.prefixes = tuple(prefixes)
+        self.regex = compile_regex_union(regexes)
+
+    def match(self, name):
+        """
+        Checks to see if the given name matches any of the patterns
+
+        Arguments:
+        name - the metric name
+
+        Returns:
+        True if the name matches; False o/w
+        """
+
+        return (name in self.exact_names or
+                name.startswith(self.prefixes) or
+                (self.regex is not None and
+                 self.regex.match(name) is not None))
+
+    def filter(self, names, keep_matches=True):
+        """
+        Filters the list of names in one pass without a method call per name.
+
+        Arguments:
+        names - list of metric names
+        keep_matches - True to keep the names that match (white list);
+                       False to keep the names that do not match (black list)
+
+        Returns:
+        The filtered list of names
+        """
+
+        exact_names = self.exact_names
+        prefixes = self.prefixes
+        if self.regex is None:
+            return [name for name in names
+                    if (name in exact_names or
+                        name.startswith(prefixes)) == keep_matches]
+
+        regex_match = self.regex.match
+        return [name for name in names
+                if (name in exact_names or
+                    name.startswith(prefixes) or
+                    regex_match(name) is not None) == keep_matches]
+
 #pylint: disable=too-many-instance-attributes
 class NewRelicPluginConfiguration(command.CommandConfiguration):
     """
@@ -48,14 +216,15 @@ class NewRelicPluginConfiguration(command.CommandConfiguration):
 
         self.fields = self.getlist('filter', 'names', [])
         self.fields_regex = self.getlist('filter', 'regex', [])
-        self.fields_regex_compiled = []
-        for regex in self.fields_regex:
-            self.fields_regex_compiled.append(re.compile(regex))
+        self.fields_regex_filter = None
+        if self.fields_regex:
+            self.fields_regex_filter = MetricNameFilter(self.fields_regex)
         self.fields_blacklist_regex = self.getlist(
             'filter', 'blacklist_regex', [])
-        self.fields_blacklist_regex_compiled = []
-        for regex in self.fields_blacklist_regex:
-            self.fields_blacklist_regex_compiled.append(re.compile(regex))
+        self.fields_blacklist_regex_filter = None
+        if self.fields_blacklist_regex:
+            self.fields_blacklist_regex_filter = MetricNameFilter(
+                self.fields_blacklist_regex)
         self.additional_fields = self.getlist('filter', 'additional_fields', [])
         self.application_ids = self.getlist('filter', 'application_ids', [])
         self.start_time = self.getdate('filter', 'start_time', None)
@@ -112,6 +281,9 @@ class NewRelicPluginConfiguration(command.CommandConfiguration):
 
         self.metric_last_sent = {}
         self.send_zero_every = int(self.get('options', 'send_zero_every', 0))
+        if not self.send_zero_every:
+            # there is no per-metric state to track so skip the time lookup
+            self.get_value_to_send = self._get_default_value
 
     def get_value_to_send(self, name, value):
         """
@@ -126,20 +298,57 @@ class NewRelicPluginConfiguration(command.CommandConfiguration):
         The value to send or None to not send
         """
 
-        if (not value or
-                str(value).lower() == 'nan' or
-                not isinstance(value, numbers.Number)):
-            value = self.default_null_value
-
-        if self.send_zero_every:
-            current = (datetime.datetime.utcnow()
-                       .replace(microsecond=0, tzinfo=dateutil.tz.tzutc()))
-            if value == 0 and name in self.metric_last_sent:
-                last_sent = self.metric_last_sent[name]
-                if (current - last_sent).total_seconds() < self.send_zero_every:
-                    value = None
-            self.metric_last_sent[name] = current
+        return self.get_value_to_send_at(int(time.time()), name, value)
+
+    def get_value_to_send_at(self, now, name, value):
+        """
+        Same as get_value_to_send() but uses the given time as the current
+        time.  Callers translating a batch of values can get the time once
+        and bind it with functools.partial().
+        Arguments:
+        now - the current time (integer epoch seconds)
+        name - the name of the metric
+        value - the value to check
+
+        Return:
+        The value to send or None to not send
+        """
+
+        value = self._get_default_value(name, value)
+        if value == 0 and name in self.metric_last_sent:
+            if now - self.metric_last_sent[name] < self.send_zero_every:
+                value = None
+        self.metric_last_sent[name] = now
+
+        return value
+
+    def get_value_translator(self):
+        """
+        Gets the function to use when translating a batch of values that
+        were retrieved at the same time.  Only looks up the current time when
+        send_zero_every is enabled.
 
+        Return:
+        Function with the same arguments as get_value_to_send()
+        """
+
+        if not self.send_zero_every:
+            return self._get_default_value
+        return functools.partial(self.get_value_to_send_at, int(time.time()))
+
+    #pylint: disable=unused-argument
+    def _get_default_value(self, name, value):
+        """
+        Replaces null, NaN and non-numeric values with the default null value.
+        This is get_value_to_send() when send_zero_every is disabled.
+        """
+
+        # NaN is the only value that is not equal to itself.  the concrete
+        # type check is faster than isinstance(value, numbers.Number)
+        if (not value or
+                value != value or
+                not isinstance(value, NUMERIC_TYPES)):
+            return self.default_null_value
         return value
 
     def validate(self):
@@ -159,6 +368,13 @@ class NewRelicMetricRetrieverCommand(NewRelicCommand):
     Command object for retrieving New Relic metrics via the REST API.
     """
 
+    # metric names loaded from the files in the cache directory (shared by
+    # all instances of this command running in this process)
+    # Key is the file path
+    # Value is a tuple of (file's stat key (see _get_stat_key()), tuple of
+    # (file's mtime, list of metric names))
+    names_file_cache = {}
+
     def __init__(self, **kwargs):
         super(NewRelicMetricRetrieverCommand, self).__init__(**kwargs)
         self.description = 'New Relic Metric Retriever'
@@ -171,6 +387,12 @@ class NewRelicMetricRetrieverCommand(NewRelicCommand):
         #   value - the list of metric names (list of strings)
         self.metric_name_cache = {}
 
+        # pool of threads running response_worker() (see _execute()) and the
+        # number of those workers currently active
+        self.pool = None
+        self.active_workers = 0
+        self.active_workers_lock = threading.Lock()
+
     #pylint: disable=no-self-use
     def get_help_text(self):
         """
@@ -189,6 +411,7 @@ class NewRelicMetricRetrieverCommand(NewRelicCommand):
 
         self.config = NewRelicPluginConfiguration(args.config_file_path)
         self.config.validate()
+        self.init_session()
         try:
             logging.config.fileConfig(args.config_file_path)
         except ConfigParser.NoSectionError:
@@ -213,20 +436,18 @@ class NewRelicMetricRetrieverCommand(NewRelicCommand):
             return []
 
         # get a hash value instead of using path so we can store on disk
-        hashval = hashlib.md5(path).hexdigest()
-        filepath = self.config.cache_directory + '/' + hashval
+        hashval = get_path_hash(path)
+        filepath = self.config.cache_directory + '/' + hashval + '.names'
 
         # cache this list so we only call once per day
         now = datetime.datetime.utcnow()
         if hashval not in self.metric_name_cache:
-            if os.path.exists(filepath):
-                with open(filepath, 'r') as contents:
-                    names = json.load(contents)
-                    self.metric_name_cache[hashval] = {
-                        'value': names,
-                        'last_refresh': datetime.datetime.fromtimestamp(
-                            os.path.getmtime(filepath))
-                    }
+            cached = self._load_names_cached(filepath)
+            if cached:
+                self.metric_name_cache[hashval] = {
+                    'value': cached[1],
+                    'last_refresh': datetime.datetime.fromtimestamp(cached[0])
+                }
 
         if hashval in self.metric_name_cache:
             last_refresh = self.metric_name_cache[hashval]['last_refresh']
@@ -265,11 +486,94 @@ class NewRelicMetricRetrieverCommand(NewRelicCommand):
             'last_refresh': now,
             'value': names
         }
-        with open(filepath, 'w') as contents:
-            json.dump(names, contents)
+        self._save_names(filepath, names)
+        file_stat = os.stat(filepath)
+        self.names_file_cache[filepath] = (
+            self._get_stat_key(file_stat), (file_stat.st_mtime, names))
 
         return names
 
+    #pylint: disable=bare-except
+    def _save_names(self, filepath, names):
+        """
+        Saves the list of metric names to the given cache file.  The names are
+        written to a new, uniquely named temporary file in the cache directory
+        that is then renamed over the cache file so that readers never see a
+        partial file and concurrent writers (threads or processes) never share
+        a temporary file.
+
+        Arguments:
+        filepath - the path to the cache file
+        names - the list of metric names
+        """
+
+        # mkstemp() creates the file exclusively (O_EXCL) so an existing file
+        # or symbolic link in the (shared) cache directory is never written
+        tmp_fd, tmp_filepath = tempfile.mkstemp(
+            suffix='.tmp', dir=self.config.cache_directory)
+        try:
+            with os.fdopen(tmp_fd, 'wb') as contents:
+                marshal.dump(names, contents)
+            os.rename(tmp_filepath, filepath)
+        except:
+            os.unlink(tmp_filepath)
+            raise
+
+    @classmethod
+    def _load_names_cached(cls, filepath):
+        """
+        Loads the list of metric names stored in the given cache file.  The
+        list is parsed once and kept in memory while the file's inode,
+        modification/change times and size stay the same (the file may be
+        rewritten or deleted by another process).
+
+        Arguments:
+        filepath - the path to the cache file
+
+        Returns:
+        Tuple of (mtime, list of metric names) or None if the file does
+        not exist
+        """
+
+        try:
+            file_stat = os.stat(filepath)
+        except OSError:
+            cls.names_file_cache.pop(filepath, None)
+            return None
+
+        stat_key = cls._get_stat_key(file_stat)
+        cached = cls.names_file_cache.get(filepath)
+        if cached and cached[0] == stat_key:
+            return cached[1]
+        cls.names_file_cache.pop(filepath, None)
+
+        # marshal (unlike pickle) cannot run code from the file; only a list
+        # is accepted so anything else is treated as a missing cache file
+        try:
+            with open(filepath, 'rb') as contents:
+                names = marshal.load(contents)
+        except (EOFError, ValueError, TypeError):
+            return None
+        if not isinstance(names, list):
+            return None
+
+        cached = (file_stat.st_mtime, names)
+        cls.names_file_cache[filepath] = (stat_key, cached)
+        return cached
+
+    @staticmethod
+    def _get_stat_key(file_stat):
+        """
+        Gets the tuple identifying the contents of a cache file (same as
+        utils.Configuration's file cache)
+
+        Arguments:
+        file_stat - the os.stat() result for the file
+        """
+
+        return (file_stat.st_dev, file_stat.st_ino, file_stat.st_mtime,
+                file_stat.st_ctime, file_stat.st_size)
+
     def _server_metrics(self, start, end):
         """
         Pull the server metrics from New Relic and post them to the WF proxy.
@@ -285,26 +589,25 @@ class NewRelicMetricRetrieverCommand(NewRelicCommand):
 
         self.logger.info('Retrieving server metrics ...')
         servers = self.call_api('/servers.json')[0]
+        is_cancelled = utils.CANCEL_WORKERS_EVENT.is_set
         for server in servers['servers']:
-            if utils.CANCEL_WORKERS_EVENT.is_set():
+            if is_cancelled():
                 return
 
             server_id = server['id']
             server_name = server['name']
-            tags = {
+            tags = prepare_tags({
                 'server_id': server_id,
                 'server_name': server_name
-            }
+            })
             if (self.config.include_server_summary and
                     'summary' in server):
-                summary = server['summary']
-                for key, value in summary.iteritems():
-                    if utils.CANCEL_WORKERS_EVENT.is_set():
-                        break
-                    metric_name = ('servers/%s/%s' % (server_name, key))
-                    self.send_metric(self.proxy, metric_name, value, 'newrelic',
-                                     server['last_reported_at'], tags,
-                                     self.config.get_value_to_send, self.logger)
+                self.send_metrics_bulk(self.proxy,
+                                       'servers/%s/' % (server_name, ),
+                                       server['summary'], 'newrelic',
+                                       server['last_reported_at'], tags,
+                                       self.config.get_value_to_send,
+                                       self.logger)
             self.send_metrics_for_server(server_id, server_name, start, end)
 
     def _application_metrics(self, start, end):
@@ -344,8 +647,9 @@ class NewRelicMetricRetrieverCommand(NewRelicCommand):
         if not response or 'applications' not in response:
             return
 
+        is_cancelled = utils.CANCEL_WORKERS_EVENT.is_set
         for app in response['applications']:
-            if utils.CANCEL_WORKERS_EVENT.is_set():
+            if is_cancelled():
                 return
             self.logger.info('Retrieving %s - %s (app: %s)',
                              str(start), str(end), app['name'])
@@ -354,40 +658,33 @@ class NewRelicMetricRetrieverCommand(NewRelicCommand):
 
             app_id = app['id']
             app_name = app['name']
-            tags = {
+            tags = prepare_tags({
                 'app_id': app_id,
                 'app_name': app_name
-            }
+            })
             if self.config.include_application_summary:
                 self.logger.info('Retrieving application summary (%s)...',
                                  app['last_reported_at'])
-                summary = app['application_summary']
-                for key, value in summary.iteritems():
-                    if utils.CANCEL_WORKERS_EVENT.is_set():
-                        break
-                    metric_name = 'apps/%s/%s' % (app_name, key)
-                    self.send_metric(self.proxy, metric_name, value,
-                                     'newrelic', app['last_reported_at'],
-                                     tags, self.config.get_value_to_send,
-                                     self.logger)
+                self.send_metrics_bulk(self.proxy, 'apps/%s/' % (app_name, ),
+                                       app['application_summary'],
+                                       'newrelic', app['last_reported_at'],
+                                       tags, self.config.get_value_to_send,
+                                       self.logger)
 
                 if 'end_user_summary' in app:
-                    summary = app['end_user_summary']
-                    for key, value in summary.iteritems():
-                        if utils.CANCEL_WORKERS_EVENT.is_set():
-                            break
-                        metric_name = 'apps/%s/enduser/%s' % (app_name, key)
-                        self.send_metric(self.proxy, metric_name, value,
-                                         'newrelic', app['last_reported_at'],
-                                         tags, self.config.get_value_to_send,
-                                         self.logger)
+                    self.send_metrics_bulk(self.proxy,
+                                           'apps/%s/enduser/' % (app_name, ),
+                                           app['end_user_summary'],
+                                           'newrelic', app['last_reported_at'],
+                                           tags, self.config.get_value_to_send,
+                                           self.logger)
 
             if ((self.config.include_hosts or
                  self.config.include_host_app_summary) and
-                    not utils.CANCEL_WORKERS_EVENT.is_set()):
+                    not is_cancelled()):
 
                 for host_id in app['links']['application_hosts']:
-                    if utils.CANCEL_WORKERS_EVENT.is_set():
+                    if is_cancelled():
                         break
                     self.send_metrics_for_host(app_id, app_name,
                                                host_id, start, end)
@@ -399,47 +696,48 @@ class NewRelicMetricRetrieverCommand(NewRelicCommand):
         reports metrics to configured endpoint.
         """
 
+        # one pool of worker threads is used for all /data.json requests
+        # during this execution (see get_metrics_for_path())
+        self.pool = ThreadPool(self.config.workers)
         try:
+            self.open_api_log()
             self.init_proxy()
             # construct start time for when to get metrics starting from
+            # and the end time (defaults to now)
+            now = (datetime.datetime.utcnow()
+                   .replace(microsecond=0, tzinfo=dateutil.tz.tzutc()))
             if self.config.start_time:
                 start = self.config.start_time
             else:
-                start = ((datetime.datetime.utcnow() -
-                          datetime.timedelta(seconds=60.0))
-                         .replace(microsecond=0, tzinfo=dateutil.tz.tzutc()))
+                start = now - datetime.timedelta(seconds=60.0)
             if self.config.end_time:
                 end = self.config.end_time
             else:
-                end = None
+                end = now
 
-            if start is not None:
-                if end is None:
-                    end = (datetime.datetime.utcnow()
-                           .replace(microsecond=0, tzinfo=dateutil.tz.tzutc()))
-
-                if (end - start).total_seconds() < self.config.min_delay:
-                    self.logger.info('Not running since %s - %s < 60',
-                                     str(end), str(start))
-                    return
+            if (end - start).total_seconds() < self.config.min_delay:
+                self.logger.info('Not running since %s - %s < 60',
+                                 str(end), str(start))
+                return
 
             start = start.replace(microsecond=0, tzinfo=dateutil.tz.tzutc())
             self.logger.info('Running %s - %s', str(start), str(end))
 
             # if the time is more than 10 minutes, NR will make the sample size
             # larger than a minute.  so, we'll grab the data in chunks
-            # (10m at a time)
-            curr_start = start
-            if not end:
-                end = (datetime.datetime.utcnow()
-                       .replace(microsecond=0, tzinfo=dateutil.tz.tzutc()))
-            curr_end = end
-            curr_diff = curr_end - curr_start
-            while (curr_diff.total_seconds() > 0 and
+            # (10m at a time).  the loop works on integer seconds relative to
+            # start and only builds datetime objects for the API calls.
+            end_s = int((end - start).total_seconds())
+            curr_start_s = 0
+            while (curr_start_s < end_s and
                    not utils.CANCEL_WORKERS_EVENT.is_set()):
-                if (curr_diff.total_seconds() > 600 or
-                        curr_diff.total_seconds() < 60):
-                    curr_end = curr_start + datetime.timedelta(minutes=10)
+                curr_diff_s = end_s - curr_start_s
+                if curr_diff_s > 600 or curr_diff_s < 60:
+                    curr_end_s = curr_start_s + 600
+                else:
+                    curr_end_s = end_s
+                curr_start = start + datetime.timedelta(seconds=curr_start_s)
+                curr_end = start + datetime.timedelta(seconds=curr_end_s)
 
                 # get the application metrics
                 self._application_metrics(curr_start, curr_end)
@@ -447,16 +745,20 @@ class NewRelicMetricRetrieverCommand(NewRelicCommand):
                 # get the servers
                 self._server_metrics(curr_start, curr_end)
 
-                # save "last run time" and update curr_* variables
+                # save "last run time" and move to the next chunk
                 self.config.set_last_run_time(curr_end)
-                curr_start = curr_end
-                curr_end = end
-                curr_diff = curr_end - curr_start
-                if (curr_diff.total_seconds() > 600 and
+                curr_start_s = curr_end_s
+                if (end_s - curr_start_s > 600 and
                         not utils.CANCEL_WORKERS_EVENT.is_set()):
                     time.sleep(30)
 
         finally:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+            self.stop_proxy()
+            self.stop_thread_writers()
+            self.close_api_log()
             self.config.start_time = None
             self.config.end_time = None
 
@@ -486,19 +788,17 @@ class NewRelicMetricRetrieverCommand(NewRelicCommand):
 
         app_host = app_host['application_host']
         host_name = app_host['host']
-        tags = {
+        tags = prepare_tags({
             'app_id': app_id,
             'app_name': app_name
-        }
+        })
         self.logger.debug('host: %s', host_name)
         if (self.config.include_host_app_summary and
                 'application_summary' in app_host):
-            summary = app_host['application_summary']
-            for key, value in summary.iteritems():
-                metric_name = 'apps/%s/%s' % (app_name, key)
-                self.send_metric(self.proxy, metric_name, value, host_name,
-                                 start.isoformat(), tags,
-                                 self.config.get_value_to_send, self.logger)
+            self.send_metrics_bulk(self.proxy, 'apps/%s/' % (app_name, ),
+                                   app_host['application_summary'], host_name,
+                                   start.isoformat(), tags,
+                                   self.config.get_value_to_send, self.logger)
 
         if not self.config.include_hosts:
             return
@@ -515,27 +815,12 @@ class NewRelicMetricRetrieverCommand(NewRelicCommand):
             path, self.config.additional_fields))
 
         # now we have a list of metric names apply some filtering based
-        # on the white and black list
-        if self.config.fields_regex:
-            for fieldname in names[:]:
-                found = False
-                for pattern in self.config.fields_regex_compiled:
-                    if pattern.match(fieldname):
-                        found = True
-                        break
-                if not found:
-                    names.remove(fieldname)
-        # black list ...
-        if self.config.fields_blacklist_regex:
-            self.logger.debug('Checking field names against black list')
-            for fieldname in names[:]:
-                found = False
-                for pattern in self.config.fields_blacklist_regex_compiled:
-                    if pattern.match(fieldname):
-                        found = True
-                        break
-                if found:
-                    names.remove(fieldname)
+        # on the white and black list (black list trumps white list)
+        if self.config.fields_regex_filter:
+            names = self.config.fields_regex_filter.filter(names)
+        if self.config.fields_blacklist_regex_filter:
+            names = self.config.fields_blacklist_regex_filter.filter(
+                names, False)
 
         self.logger.debug('%d Metric names for path %s:\n%s',
                           len(names), path, str(names))
@@ -554,10 +839,10 @@ class NewRelicMetricRetrieverCommand(NewRelicCommand):
 
         path = '/servers/%s' % (server_id)
         fields = self.get_metric_names_for_path(path, [])
-        tags = {
+        tags = prepare_tags({
             'server_id': server_id,
             'server_name': server_name
-        }
+        })
         self.get_metrics_for_path(path, fields, start, end, server_name, tags)
 
     #pylint: disable=too-many-arguments
@@ -572,7 +857,7 @@ class NewRelicMetricRetrieverCommand(NewRelicCommand):
         start -
         end -
         src_name -
-        tags
+        tags - the point tags string (see metrics_writer.prepare_tags())
         """
 
         if utils.CANCEL_WORKERS_EVENT.is_set():
@@ -582,32 +867,56 @@ class NewRelicMetricRetrieverCommand(NewRelicCommand):
                           path, src_name, str(tags))
 
         # there is a limit on the size of the query string.  we pick a
-        # max number of metric names to get on each request and loop
-        # until we've got all metric values.
-        # fields_to_get_temp contains all the remaining metric names
-        # to get. as each group of metric names is retrieved, they are
-        # removed (see end of loop).
-        # during each iteration, get the first X (max) metric values.
-        fields_to_get_temp = list(fields_to_get)
-
-        function_pointers = []
-        while len(fields_to_get_temp) > 0:
+        # max number of metric names to get on each request and step
+        # through the list X (max) metric names at a time.
+        max_names = self.config.max_metric_names
+        start_iso = start.isoformat()
+        end_iso = end.isoformat()
+        results = []
+        for index in range(0, len(fields_to_get), max_names):
             query_string = {
-                'from': start.isoformat(),
-                'to': end.isoformat(),
-                'names[]': fields_to_get_temp[0:self.config.max_metric_names],
+                'from': start_iso,
+                'to': end_iso,
+                'names[]': fields_to_get[index:index + max_names],
                 'raw': True,
                 'summarize': False
             }
-            del fields_to_get_temp[0:self.config.max_metric_names]
 
-            function_pointers.append((self.response_worker,
-                                      (path, query_string, src_name, tags)))
+            results.append(self.pool.apply_async(
+                self._response_worker_task,
+                (path, query_string, src_name, tags)))
 
         self.logger.debug('Metrics for path %s: work queue has %d items',
-                          path, len(function_pointers))
-        parallel_process_and_wait(function_pointers, self.config.workers,
-                                  self.logger)
+                          path, len(results))
+
+        # wait for all of this path's work to finish.  the timeout allows
+        # signals to be handled and gives us debug information every 60s
+        for result in results:
+            while not result.ready():
+                result.wait(60.0)
+                if not result.ready():
+                    self.logger.debug('%s: %d response worker(s) active',
+                                      path, self.active_workers)
+
+    #pylint: disable=bare-except
+    def _response_worker_task(self, path, query_string, src_name, tags):
+        """
+        Runs response_worker() in the worker pool, tracking the number of
+        active workers and logging any failure.
+        """
+
+        if utils.CANCEL_WORKERS_EVENT.is_set():
+            return
+
+        with self.active_workers_lock:
+            self.active_workers = self.active_workers + 1
+        try:
+            self.response_worker(path, query_string, src_name, tags)
+        except:
+            self.logger.exception('Failed to run response worker')
+        finally:
+            with self.active_workers_lock:
+                self.active_workers = self.active_workers - 1
 
     def response_worker(self, path, query_string, src_name, tags):
         """
@@ -615,30 +924,34 @@ class NewRelicMetricRetrieverCommand(NewRelicCommand):
         and process the response.
         """
 
-        response = self.call_api(path + '/metrics/data.json', query_string)[0]
-        if not response or 'metric_data' not in response:
-            self.logger.warning('%s: response does not contain metric_data',
-                                path)
+        metrics = self.call_api_stream(path + '/metrics/data.json',
+                                       query_string,
+                                       'metric_data.metrics.item')
+        if metrics is None:
             return
 
-        # need to get a new writer for each thread (create a new socket)
-        writer = NewRelicCommand.get_writer_from_config(self.config)
+        # each thread has its own writer (socket) that is reused across calls
+        # and buffers the lines so they are sent in a few large writes
+        writer = self.get_thread_writer()
+        value_translator = self.config.get_value_translator()
+
+        # local names avoid repeated attribute lookups in the loop below
+        is_cancelled = utils.CANCEL_WORKERS_EVENT.is_set
+        send_metric = NewRelicCommand.send_metric
 
         try:
-            # parse and collect the metrics
-            metrics = response['metric_data']['metrics']
+            # metrics are sent as they are parsed from the response
             for metric_detail in metrics:
-                if utils.CANCEL_WORKERS_EVENT.is_set():
+                if is_cancelled():
                     break
                 name = metric_detail['name']
                 for time_slice in metric_detail['timeslices']:
+                    timestamp = time_slice['to']
                     for metric, value in time_slice['values'].iteritems():
-                        if utils.CANCEL_WORKERS_EVENT.is_set():
+                        if is_cancelled():
                             break
-                        metric_name = '%s/%s' % (name, metric)
-                        NewRelicCommand.send_metric(
-                            writer, metric_name, value, src_name,
-                            time_slice['to'], tags,
-                            self.config.get_value_to_send)
+                        send_metric(writer, '%s/%s' % (name, metric), value,
+                                    src_name, timestamp, tags,
+                                    value_translator, self.logger)
         finally:
-            writer.stop()
+            self.flush_thread_writer()
@@ -2,26 +2,171 @@
 This is common code used by the New Relic plugin.
 """
 
+import calendar
 import datetime
-import json
+import functools
+import itertools
 import logging
 import numbers
+import Queue
+import random
+import re
+import socket
 import sys
+import threading
 import time
 
-import urllib2
-import urlparse
+from multiprocessing.pool import ThreadPool
 import dateutil
+import requests
 
 from wavefront.metrics_writer import WavefrontMetricsWriter
 from wavefront import command
 from wavefront import utils
 
+# the API responses can be large so use a faster JSON decoder when one is
+# installed (ujson); o/w fall back to the standard library.  precise_float
+# makes ujson decode floats exactly like the json module does.
+try:
+    import ujson
+    json_loads = functools.partial(ujson.loads, precise_float=True)
+except ImportError:
+    from json import loads as json_loads
+
+# ijson (optional) allows large API responses to be processed while they are
+# being read instead of decoding the whole response first
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# errors raised while a streamed response is read and parsed.  the call is
+# retried when one of these is raised (see NewRelicCommand.call_api_stream())
+STREAM_READ_ERRORS = (
+    requests.exceptions.RequestException,
+    requests.packages.urllib3.exceptions.HTTPError,
+    EnvironmentError)
+if ijson is not None:
+    STREAM_READ_ERRORS = STREAM_READ_ERRORS + (ijson.JSONError, )
+
 # http://bugs.python.org/issue7980
-# bug indicates that datetime.datetime.strptime() must be called once before
-# multiple threads are started that use this function.
-datetime.datetime.strptime('2016-04-27T13:30:15+00:00',
-                           '%Y-%m-%dT%H:%M:%S+00:00')
+# bug indicates that the first call to datetime.datetime.strptime() must not
+# be made by multiple threads at once.  strptime() is only needed for
+# timestamps _fast_iso_utc() cannot parse so its calls are serialized
+# instead of calling it when this module is imported.
+_STRPTIME_LOCK = threading.Lock()
+
+# number of bytes each worker thread's writer collects before sending them to
+# the proxy in a single write
+WRITER_BUFFER_SIZE = 8192
+
+# metric data responses smaller than this (bytes) are read in full and
+# decoded at once rather than parsed while streaming (see call_api_stream())
+STREAM_MIN_BYTES = 1048576
+
+# number of times MetricBatcher tries to send each batch before giving up
+METRIC_BATCH_SEND_ATTEMPTS = 5
+# seconds MetricBatcher waits for room in its queue before checking that its
+# background thread is still running
+METRIC_BATCH_PUT_TIMEOUT = 1.0
+
+# buffer size (bytes) of the API log file (api.log_path)
+API_LOG_BUFFER_SIZE = 65536
+
+# maximum delay (seconds) before the first retry of a failed API call.  the
+# maximum doubles with each retry (see NewRelicCommand._sleep_backoff())
+API_RETRY_BASE_DELAY = 5.0
+# maximum delay (seconds) before any retry of a failed API call
+API_RETRY_MAX_DELAY = 60.0
+# HTTP status codes (besides 5xx) of API calls that are retried
+RETRY_HTTP_STATUSES = (429, )
+
+# matches the page number and relation of each link in the Link header
+LINK_HEADER_RE = re.compile(
+    r'[?&]page=(\d+)[^>]*>;\s*rel="(first|prev|next|last)"')
+# Link header relation => key in the parse_link_header() result
+LINK_RELS = {'prev': 'previous'}
+
+# the API returns the same few timestamps for every metric in a response so
+# the parsed values are cached (up to ISO_TO_EPOCH_CACHE_SIZE timestamps)
+ISO_TO_EPOCH_CACHE_SIZE = 8192
+_ISO_TO_EPOCH_CACHE = {}
+
+def _iso_to_epoch(timestamp):
+    """
+    Converts the ISO 8601 (UTC) timestamp string returned by the API to
+    epoch seconds.  Results are cached.
+
+    Arguments:
+    timestamp - the timestamp string (e.g., 2016-04-27T13:30:15+00:00)
+    """
+
+    seconds = _ISO_TO_EPOCH_CACHE.get(timestamp)
+    if seconds is not None:
+        return seconds
+
+    seconds = _fast_iso_utc(timestamp)
+    if seconds is None:
+        with _STRPTIME_LOCK:
+            parsed_date = datetime.datetime.strptime(
+                timestamp, '%Y-%m-%dT%H:%M:%S+00:00')
+        parsed_date = parsed_date.replace(tzinfo=dateutil.tz.tzutc())
+        seconds = utils.unix_time_seconds(parsed_date)
+    if len(_ISO_TO_EPOCH_CACHE) >= ISO_TO_EPOCH_CACHE_SIZE:
+        _ISO_TO_EPOCH_CACHE.clear()
+    _ISO_TO_EPOCH_CACHE[timestamp] = seconds
+    return seconds
+
+# the exact timestamp format returned by the API (UTC)
+FAST_ISO_UTC_RE = re.compile(
+    r'(\d{4})-(\d{2})-(\d{2})T(\d{2}):(\d{2}):(\d{2})\+00:00\Z')
+
+def _fast_iso_utc(timestamp):
+    """
+    Converts a timestamp string in the exact format the API uses
+    (YYYY-MM-DDTHH:MM:SS+00:00) to epoch seconds without strptime()
+
+    Arguments:
+    timestamp - the timestamp string
+
+    Returns:
+    The epoch seconds or None if the string is not in that format or is not
+    a valid date/time (strptime() is left to handle/reject those)
+    """
+
+    matched = FAST_ISO_UTC_RE.match(timestamp)
+    if matched is None:
+        return None
+
+    year, month, day, hour, minute, second = [
+        int(value) for value in matched.groups()]
+    if (year < 1 or not 1 <= month <= 12 or
+            not 1 <= day <= calendar.monthrange(year, month)[1] or
+            hour > 23 or minute > 59 or second > 59):
+        return None
+    return calendar.timegm((year, month, day, hour, minute, second, 0, 0, 0))
+
+# metric names repeat in every poll so the Wavefront name of each New Relic
+# metric is cached (up to WF_METRIC_NAME_CACHE_SIZE names)
+WF_METRIC_NAME_CACHE_SIZE = 16384
+_WF_METRIC_NAME_CACHE = {}
+
+def _get_wf_metric_name(name):
+    """
+    Gets the Wavefront metric name ('newrelic.' + the sanitized name) of a
+    New Relic metric.  Results are cached.
+
+    Arguments:
+    name - the New Relic metric name
+    """
+
+    wf_name = _WF_METRIC_NAME_CACHE.get(name)
+    if wf_name is None:
+        wf_name = 'newrelic.' + utils.sanitize_name(name)
+        if len(_WF_METRIC_NAME_CACHE) >= WF_METRIC_NAME_CACHE_SIZE:
+            _WF_METRIC_NAME_CACHE.clear()
+        _WF_METRIC_NAME_CACHE[name] = wf_name
+    return wf_name
 
 class NewRelicCommand(command.Command):
     """
@@ -33,28 +178,184 @@ class NewRelicCommand(command.Command):
         self.config = None
         self.proxy = None
 
+        # HTTP session (keep-alive connection pool) used for all API calls.
+        # created by init_session() once the configuration is loaded
+        self.session = None
+
+        # each worker thread keeps its own writer (socket to the proxy) in
+        # thread_writers; all writers created are tracked in open_writers
+        # so they can be stopped by stop_thread_writers()
+        self.thread_writers = threading.local()
+        self.open_writers = []
+        self.open_writers_lock = threading.Lock()
+
+        # the API log file (api.log_path) is opened by open_api_log() and
+        # written to by all threads
+        self.api_log_fd = None
+        self.api_log_lock = threading.Lock()
+
+    def init_session(self):
+        """
+        Initializes the HTTP session used for all API calls.  The headers are
+        set once on the session and the connection pool is sized so each
+        worker thread can keep its own connection to the API open.
+        """
+
+        self.session = requests.Session()
+        self.session.headers.update({
+            'Accept': 'application/json',
+            self.config.api_key_header_name: self.config.api_key
+        })
+        # retries are handled by call_api()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=4, pool_maxsize=self.config.workers,
+            max_retries=0)
+        self.session.mount('https://', adapter)
+
+    def open_api_log(self):
+        """
+        Opens the API log file (when configured) so each API call does not
+        have to open it.  Closed by close_api_log().
+        """
+
+        if self.config.api_log_path and self.api_log_fd is None:
+            self.api_log_fd = open(self.config.api_log_path, 'a',
+                                   API_LOG_BUFFER_SIZE)
+
+    def close_api_log(self):
+        """
+        Closes the API log file opened by open_api_log()
+        """
+
+        with self.api_log_lock:
+            if self.api_log_fd is not None:
+                self.api_log_fd.close()
+                self.api_log_fd = None
+
+    def _write_api_log(self, url, json_response):
+        """
+        Writes the URL and response of an API call to the API log file (if
+        opened) with a single write
+
+        Arguments:
+        url - the URL called
+        json_response - the JSON object returned (None if the call failed)
+        """
+
+        if json_response is None:
+            lines = url + '\n'
+        else:
+            lines = '%s\n%s\n' % (url, str(json_response))
+        with self.api_log_lock:
+            if self.api_log_fd is not None:
+                self.api_log_fd.write(lines)
+
     def init_proxy(self):
         """
-        Initializes the proxy writer
+        Initializes the proxy writer.  The writer is shared by all threads
+        so metrics written to it are batched (see MetricBatcher).
         """
 
-        self.proxy = self.get_writer_from_config(self.config)
+        self.proxy = MetricBatcher(
+            self.get_writer_from_config(self.config, WRITER_BUFFER_SIZE),
+            self.logger)
+
+    def stop_proxy(self):
+        """
+        Sends the metrics queued for the proxy writer and stops it
+        """
+
+        if self.proxy is not None:
+            self.proxy.close()
+            self.proxy = None
 
     @staticmethod
-    def get_writer_from_config(config):
+    def get_writer_from_config(config, buffer_size=0):
         """
         Creates a new metrics writer pointed to the proxy using the given
         config object and starts it
 
         Arguments:
         config - the configuration
+        buffer_size - number of bytes to buffer before writing (0 = none)
         """
         proxy = WavefrontMetricsWriter(config.writer_host,
                                        config.writer_port,
-                                       config.is_dry_run)
+                                       config.is_dry_run,
+                                       buffer_size)
         proxy.start()
         return proxy
 
+    def get_thread_writer(self):
+        """
+        Gets the metrics writer for the current thread.  The writer is created
+        and started on the first call in each thread and reused by later calls
+        so that the socket to the proxy stays open.  The writer buffers its
+        output; see flush_thread_writer().  A writer whose flush fails is
+        replaced (see drop_thread_writer()).
+        """
+
+        writer = getattr(self.thread_writers, 'writer', None)
+        if writer is None:
+            writer = self.get_writer_from_config(self.config,
+                                                 WRITER_BUFFER_SIZE)
+            self.thread_writers.writer = writer
+            with self.open_writers_lock:
+                self.open_writers.append(writer)
+        return writer
+
+    def flush_thread_writer(self):
+        """
+        Sends any metrics buffered by the current thread's writer
+        """
+
+        writer = getattr(self.thread_writers, 'writer', None)
+        if writer is None:
+            return
+
+        try:
+            writer.flush()
+        except socket.error as sock_err:
+            self.logger.warning('Failed to flush writer: %s', str(sock_err))
+            self.drop_thread_writer()
+
+    def drop_thread_writer(self):
+        """
+        Stops the current thread's writer and forgets it so that the next
+        get_thread_writer() call in this thread creates a new one (with a new
+        connection to the proxy).  The buffered lines get one more chance to
+        be sent when the writer is stopped.
+        """
+
+        writer = getattr(self.thread_writers, 'writer', None)
+        if writer is None:
+            return
+
+        self.thread_writers.writer = None
+        with self.open_writers_lock:
+            if writer in self.open_writers:
+                self.open_writers.remove(writer)
+        try:
+            writer.stop()
+        except socket.error as sock_err:
+            self.logger.warning('Failed to stop writer: %s', str(sock_err))
+
+    def stop_thread_writers(self):
+        """
+        Stops all writers created by get_thread_writer()
+        """
+
+        with self.open_writers_lock:
+            writers = self.open_writers
+            self.open_writers = []
+            self.thread_writers = threading.local()
+
+        for writer in writers:
+            try:
+                writer.stop()
+            except socket.error as sock_err:
+                self.logger.warning('Failed to stop writer: %s', str(sock_err))
+
     #pylint: disable=too-many-arguments
     #pylint: disable=bare-except
     @staticmethod
@@ -68,17 +369,13 @@ class NewRelicCommand(command.Command):
         value - the numeric value
         host - the source/host
         timestamp - the timestamp (epoch seconds) or datetime object
-        tags - dictionary of tags
+        tags - dictionary of tags or the tags string returned from
+               metrics_writer.prepare_tags()
         value_translator - function pointer to function that will translate
             value from current form to something else
         """
 
-        if not isinstance(timestamp, numbers.Number):
-            parsed_date = datetime.datetime.strptime(timestamp,
-                                                     '%Y-%m-%dT%H:%M:%S+00:00')
-            parsed_date = parsed_date.replace(tzinfo=dateutil.tz.tzutc())
-            timestamp = utils.unix_time_seconds(parsed_date)
-
+        timestamp = NewRelicCommand._get_epoch_seconds(timestamp)
         if value_translator:
             value = value_translator(name, value)
             if value is None:
@@ -87,15 +384,85 @@ class NewRelicCommand(command.Command):
         attempts = 0
         while attempts < 5 and not utils.CANCEL_WORKERS_EVENT.is_set():
             try:
-                writer.transmit_metric('newrelic.' + utils.sanitize_name(name),
+                writer.transmit_metric(_get_wf_metric_name(name),
                                        value, int(timestamp), host, tags)
                 break
             except:
                 attempts = attempts + 1
                 logger.warning('Failed to transmit metric %s: %s',
                                name, str(sys.exc_info()))
-                if not utils.CANCEL_WORKERS_EVENT.is_set():
-                    time.sleep(1)
+                NewRelicCommand._sleep_backoff(attempts - 1)
+
+    #pylint: disable=too-many-arguments
+    #pylint: disable=bare-except
+    @staticmethod
+    def send_metrics_bulk(writer, prefix, values, host, timestamp, tags=None,
+                          value_translator=None, logger=None):
+        """
+        Sends all values in a dictionary (e.g., an application summary) to
+        writer in a single write.
+
+        Arguments:
+        prefix - the prefix of each metric name (the key is appended to it)
+        values - dictionary of metric name (key) to numeric value
+        host - the source/host
+        timestamp - the timestamp (epoch seconds) or datetime object
+        tags - dictionary of tags or the tags string returned from
+               metrics_writer.prepare_tags()
+        value_translator - function pointer to function that will translate
+            value from current form to something else
+        """
+
+        timestamp = int(NewRelicCommand._get_epoch_seconds(timestamp))
+        metrics = []
+        for key, value in values.items():
+            name = prefix + key
+            if value_translator:
+                value = value_translator(name, value)
+                if value is None:
+                    continue
+            metrics.append((_get_wf_metric_name(name), value))
+
+        attempts = 0
+        while attempts < 5 and not utils.CANCEL_WORKERS_EVENT.is_set():
+            try:
+                writer.transmit_metrics(metrics, timestamp, host, tags)
+                break
+            except:
+                attempts = attempts + 1
+                logger.warning('Failed to transmit metrics %s*: %s',
+                               prefix, str(sys.exc_info()))
+                NewRelicCommand._sleep_backoff(attempts - 1)
+
+    @staticmethod
+    def _sleep_backoff(attempt, base=1.0, cap=30.0):
+        """
+        Sleeps before retrying a failed operation.  The delay is a random
+        value between 0 and min(cap, base * 2^attempt) seconds ("full
+        jitter") so that workers failing at the same time do not all retry
+        at the same time.  Returns early when the workers are cancelled.
+
+        Arguments:
+        attempt - the number of the retry (0 for the first one)
+        base - the maximum delay (seconds) for the first retry
+        cap - the maximum delay (seconds) for any retry
+        """
+
+        delay = min(cap, base * (2 ** attempt)) * random.random()
+        utils.CANCEL_WORKERS_EVENT.wait(delay)
+
+    @staticmethod
+    def _get_epoch_seconds(timestamp):
+        """
+        Converts the timestamp returned by the API to epoch seconds
+
+        Arguments:
+        timestamp - epoch seconds or ISO 8601 string (UTC)
+        """
+
+        if isinstance(timestamp, numbers.Number):
+            return timestamp
+        return _iso_to_epoch(timestamp)
 
     #pylint: disable=line-too-long
     def call_paginated_api(self, path, query_string, callback, callback_args):
@@ -115,51 +482,199 @@ class NewRelicCommand(command.Command):
         callback_args - the args to pass to the page callback function
         """
 
-        full_response = []
+        base_query_string = query_string or {}
         def get_page_response(page):
             """
             Gets a single page's response and calls the callback function
             Arguments:
             page - the page to retrieve
             Returns:
-            The tuple of (json response, original urllib2 response object)
+            The tuple of (json response, original requests response object)
             """
 
-            if query_string:
-                page_query_string = query_string.copy()
-            else:
-                page_query_string = {}
-            page_query_string['page'] = page
-
-            tpl = self.call_api(path, page_query_string)
+            tpl = self.call_api(path, dict(base_query_string, page=page))
             if utils.CANCEL_WORKERS_EVENT.is_set():
                 return tpl
 
             if callback:
                 args = (tpl[0], ) + callback_args
                 callback(*args)
-            else:
-                full_response.append(tpl[0])
             return tpl
 
+        #pylint: disable=bare-except
+        def get_page_response_task(page):
+            """
+            Runs get_page_response() in the page pool and logs any failure
+            """
+
+            try:
+                return get_page_response(page)
+            except:
+                self.logger.exception('Failed to get page %d of %s',
+                                      page, path)
+                return (None, None)
+
         # get the first page and see if there are more by inspecting header
         tpl = get_page_response(1)
         if utils.CANCEL_WORKERS_EVENT.is_set():
-            return full_response
+            return []
+        full_response = [tpl[0]]
 
-        link = self.parse_link_header(tpl[1].info().getheader('Link'))
-
-        # build a list of function pointers - one per page
-        function_pointers = []
-        for page in range(2, link['last'] + 1):
-            function_pointers.append((get_page_response, (page,)))
+        link = self.parse_link_header(tpl[1].headers.get('Link'))
+        pages = range(2, link['last'] + 1)
+        if pages:
+            pool = ThreadPool(min(self.config.workers, len(pages)))
+            try:
+                result = pool.map_async(get_page_response_task, pages)
+                # the timeout allows signals to be handled and gives us debug
+                # information every 60s
+                while not result.ready():
+                    result.wait(60.0)
+                    if not result.ready():
+                        self.logger.debug('%s: waiting for %d page(s)',
+                                          path, len(pages))
+                # results are in page order
+                full_response.extend([page_tpl[0]
+                                      for page_tpl in result.get()])
+            finally:
+                pool.close()
+                pool.join()
 
-        utils.parallel_process_and_wait(function_pointers, self.config.workers,
-                                        self.logger)
         # empty unless callback is None
+        if callback:
+            return []
         return full_response
 
-    def call_api(self, path, query_string=None):
+    def call_api_stream(self, path, query_string, prefix):
+        """
+        Calls the New Relic API and iterates over the objects found at the
+        given prefix in the response as they are read (requires ijson).
+        When ijson is not installed or the API log is enabled the whole
+        response is decoded first.
+
+        Arguments:
+        path - the path of the API
+        query_string - the query string
+        prefix - the location of the objects in the response in ijson
+                 prefix syntax (e.g., 'metric_data.metrics.item')
+
+        Returns:
+        Iterator of objects or None if the call failed
+        """
+
+        if ijson is None or self.config.api_log_path:
+            json_response = self.call_api(path, query_string)[0]
+            return self._iter_items_at_prefix(path, json_response, prefix)
+
+        response = self.call_api(path, query_string, stream=True)[1]
+        if response is None:
+            return None
+
+        # small responses are read in full and decoded at once.  this is
+        # faster than incremental parsing and releases the connection before
+        # the items are processed
+        length = response.headers.get('Content-Length')
+        if length and length.isdigit() and int(length) < STREAM_MIN_BYTES:
+            try:
+                json_response = json_loads(response.content)
+            except requests.exceptions.RequestException as err:
+                # the body could not be read; call again (with retries)
+                self.logger.warning('Failed to read %s: %s', path, str(err))
+                json_response = self.call_api(path, query_string)[0]
+            except ValueError as err:
+                self.logger.warning('Failed to read %s: %s', path, str(err))
+                return None
+            finally:
+                response.close()
+
+            if not json_response:
+                return None
+            try:
+                self._raise_for_api_error(json_response)
+            except ValueError:
+                return None
+            return self._iter_items_at_prefix(path, json_response, prefix)
+
+        return self._iter_stream_items(path, query_string, prefix, response)
+
+    def _iter_items_at_prefix(self, path, json_response, prefix):
+        """
+        Gets an iterator over the objects at the given prefix (see
+        call_api_stream()) of a decoded response
+
+        Arguments:
+        path - the path of the API (for logging)
+        json_response - the decoded response
+        prefix - the location of the objects in ijson prefix syntax
+
+        Returns:
+        Iterator of objects or None if the response does not contain prefix
+        """
+
+        if not json_response:
+            return None
+        node = json_response
+        for key in prefix.split('.')[:-1]:
+            if not isinstance(node, dict) or key not in node:
+                self.logger.warning('%s: response does not contain %s',
+                                    path, key)
+                return None
+            node = node[key]
+        return iter(node)
+
+    def _iter_stream_items(self, path, query_string, prefix, response):
+        """
+        Generator of the objects at prefix read from the body of a streamed
+        response.  The response is closed when done.  A response whose body
+        is an API error ({"error": ...}) is logged and yields nothing.  When
+        reading or parsing the body fails the call is made again (up to 5
+        attempts in total) and the objects already returned are skipped.
+
+        Arguments:
+        path - the path of the API
+        query_string - the query string
+        prefix - the location of the objects in ijson prefix syntax
+        response - the streamed response (see call_api())
+        """
+
+        yielded = 0
+        attempts = 0
+        while response is not None:
+            try:
+                events = ijson.parse(response.raw)
+                first_events = list(itertools.islice(events, 2))
+                events = itertools.chain(first_events, events)
+                if (len(first_events) == 2 and
+                        first_events[1] == ('', 'map_key', 'error')):
+                    error = next(ijson.common.items(events, 'error'), '')
+                    try:
+                        self._raise_for_api_error({'error': error})
+                    except ValueError:
+                        return
+
+                skip = yielded
+                for item in ijson.common.items(events, prefix):
+                    if skip:
+                        skip = skip - 1
+                        continue
+                    yielded = yielded + 1
+                    yield item
+                return
+
+            except STREAM_READ_ERRORS as err:
+                self.logger.warning('Failed to read %s: %s', path, str(err))
+
+            finally:
+                response.close()
+
+            attempts = attempts + 1
+            if attempts >= 5 or utils.CANCEL_WORKERS_EVENT.is_set():
+                return
+            self._sleep_backoff(attempts - 1, API_RETRY_BASE_DELAY,
+                                API_RETRY_MAX_DELAY)
+            response = self.call_api(path, query_string, stream=True)[1]
+
+    def call_api(self, path, query_string=None, stream=False):
         """
         Calls the New Relic API in a retry loop until no error or limit
         is reached
@@ -167,6 +682,8 @@ class NewRelicCommand(command.Command):
         Arguments:
         path - the path of the API
         query_string - the query string (optional)
+        stream - when True, a successful response's body is not read and
+                 the JSON object returned is None (see call_api_stream())
 
         Returns:
         Tuple: JSON object parsed from the string returned by the URL and the
@@ -174,78 +691,78 @@ class NewRelicCommand(command.Command):
         """
 
         attempts = 0
-        sleep_time = 5
         while attempts < 5 and not utils.CANCEL_WORKERS_EVENT.is_set():
             try:
-                return self._call_api(path, query_string)
-            except urllib2.HTTPError, err:
-                if err.code == 500:
-                    attempts = attempts + 1
-                    if not utils.CANCEL_WORKERS_EVENT.is_set():
-                        time.sleep(sleep_time)
-                        sleep_time = sleep_time * 2
-                    else:
-                        return (None, None)
-                else:
-                    raise
-
-            except ValueError:
-                attempts = attempts + 1
-                if not utils.CANCEL_WORKERS_EVENT.is_set():
-                    time.sleep(sleep_time)
-                    sleep_time = sleep_time * 2
-                else:
+                return self._call_api(path, query_string, stream)
+            except requests.exceptions.HTTPError as err:
+                status = 0
+                if err.response is not None:
+                    status = err.response.status_code
+                if status < 500 and status not in RETRY_HTTP_STATUSES:
+                    # client errors (bad request, bad API key, etc.) fail the
+                    # same way when retried
                     return (None, None)
 
-        return (None, None)
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout,
+                    requests.exceptions.ChunkedEncodingError):
+                pass
 
+            except (requests.exceptions.RequestException, ValueError):
+                # invalid request or response (e.g., not JSON); not retried
+                return (None, None)
+
+            attempts = attempts + 1
+            self._sleep_backoff(attempts - 1, API_RETRY_BASE_DELAY,
+                                API_RETRY_MAX_DELAY)
+
+        return (None, None)
 
-    def _call_api(self, path, query_string=None):
+    def _call_api(self, path, query_string=None, stream=False):
         """
         Calls the New Relic API and parses response as JSON
 
         Arguments:
         path - the path of the API
         query_string - the query string (optional)
+        stream - when True, a successful response is returned without
+                 reading its body (the JSON object returned is None)
 
         Returns:
         Tuple: JSON object parsed from the string returned by the URL and the
         original HTTP response object.
         """
 
-        # build the URL
+        # the query string is encoded by requests.  url is replaced by the
+        # full URL (with the query string) once the request is sent
         url = self.config.api_endpoint + path
-        self.logger.debug('%s', url)
-        if query_string:
-            url = '%s?%s' % (url, utils.urlencode_utf8(query_string))
-
-        if self.config.api_log_path:
-            with open(self.config.api_log_path, 'a') as log_fd:
-                log_fd.write(url + '\n')
-
-        # create the request object
-        req = urllib2.Request(url=url)
-        req.add_header('Accept', 'application/json')
-        req.add_header(self.config.api_key_header_name, self.config.api_key)
+        self.logger.debug('%s %s', url, query_string or '')
 
+        json_response = None
         try:
-            response = urllib2.urlopen(req, timeout=30)
-            json_response = json.load(response)
-
-        except urllib2.HTTPError as http_err:
-            self.logger.warning('Failed [%s]: %s', url, str(http_err))
-            try:
-                json_response = json.load(http_err)
-
-            except:
-                json_err = sys.exc_info()[1]
-                self.logger.warning('Failed to load JSON [%s]: %s',
-                                    url, str(json_err))
-                raise ValueError(str(json_err))
-
-        except urllib2.URLError as url_err:
-            self.logger.warning('Failed [%s]: %s', url, str(url_err))
-            raise ValueError(str(url_err))
+            response = self.session.get(url, params=query_string, timeout=30,
+                                        stream=stream)
+            url = response.url
+            if not response.ok:
+                self.logger.warning('Failed [%s]: HTTP %d %s\n%s', url,
+                                    response.status_code, response.reason,
+                                    response.content[:1024])
+                response.raise_for_status()
+            elif stream:
+                # the caller reads the (decompressed) body from response.raw
+                response.raw.decode_content = True
+                return (None, response)
+            json_response = json_loads(response.content)
+
+        except requests.exceptions.RequestException as req_err:
+            # raised as is so call_api() can tell which errors to retry
+            self.logger.warning('Failed [%s]: %s', url, str(req_err))
+            raise
+
+        except ValueError as json_err:
+            self.logger.warning('Failed to load JSON [%s]: %s',
+                                url, str(json_err))
+            raise ValueError(str(json_err))
 
         except BaseException as base_ex:
             self.logger.warning('Failed (1) [%s]: %s', url, str(base_ex))
@@ -255,9 +772,24 @@ class NewRelicCommand(command.Command):
             self.logger.warning('Failed [%s]: %s', url, str(sys.exc_info()))
             raise ValueError('Unknown failure with ' + url)
 
-        if self.config.api_log_path:
-            with open(self.config.api_log_path, 'a') as log_fd:
-                log_fd.write('%s\n' % (str(json_response)))
+        finally:
+            if self.api_log_fd is not None:
+                self._write_api_log(url, json_response)
+
+        self._raise_for_api_error(json_response)
+        return (json_response, response)
+
+    def _raise_for_api_error(self, json_response):
+        """
+        Logs and raises the error returned by the API in the body of a
+        response (e.g., {"error": {"title": "..."}})
+
+        Arguments:
+        json_response - the decoded response
+
+        Raises:
+        ValueError if the response contains an error
+        """
 
         if 'error' in json_response:
             if 'title' in json_response['error']:
@@ -269,8 +801,6 @@ class NewRelicCommand(command.Command):
                                     str(json_response))
                 raise ValueError(json_response['error'])
 
-        return (json_response, response)
-
     @staticmethod
     def parse_link_header(link):
         """
@@ -296,23 +826,156 @@ class NewRelicCommand(command.Command):
             'previous': 0
         }
 
-        if not link:
-            return rtn
-
         #  Link: <.../v2/applications/X/metrics.json?page=1>; rel="first",
-        parts = link.split(', ')
-        for part in parts:
-            components = part.split('; ')
-            url = components[0][1:-1]
-            result = urlparse.parse_qs(urlparse.urlparse(url).query)
-            page = int(result['page'][0])
-            if components[1] == 'rel="first"':
-                rtn['first'] = page
-            elif components[1] == 'rel="prev"':
-                rtn['previous'] = page
-            elif components[1] == 'rel="last"':
-                rtn['last'] = page
-            elif components[1] == 'rel="next"':
-                rtn['next'] = page
+        for page, rel in LINK_HEADER_RE.findall(link or ''):
+            rtn[LINK_RELS.get(rel, rel)] = int(page)
 
         return rtn
+
+class MetricBatcher(object):
+    """
+    Collects metrics written by any number of threads and sends them to a
+    single writer from a background thread.  The metrics queued within
+    interval seconds (up to max_metrics) are sent with a single write, so
+    the writer is only ever used by one thread.  Same interface as
+    metrics_writer.MetricsWriter.transmit_metric() / transmit_metrics().
+    """
+
+    #pylint: disable=too-many-arguments
+    def __init__(self, writer, logger, max_metrics=1000, interval=0.1,
+                 max_queued=10000):
+        """
+        Arguments:
+        writer - the started metrics writer the batches are sent to
+        logger - the logger
+        max_metrics - the maximum number of metrics in each batch
+        interval - the maximum time (seconds) to wait for a batch to fill
+        max_queued - the maximum number of writes waiting to be sent
+        """
+
+        self.writer = writer
+        self.logger = logger
+        self.max_metrics = max_metrics
+        self.interval = interval
+        self.queue = Queue.Queue(max_queued)
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def transmit_metric(self, name, value, timestamp, source, point_tags):
+        """
+        Queues a metric to be sent (see MetricsWriter.transmit_metric())
+        """
+
+        self._put(([(name, value)], timestamp, source, point_tags))
+
+    def transmit_metrics(self, metrics, timestamp, source, point_tags):
+        """
+        Queues metrics to be sent (see MetricsWriter.transmit_metrics())
+        """
+
+        if metrics:
+            self._put((metrics, timestamp, source, point_tags))
+
+    def close(self):
+        """
+        Sends all queued metrics and stops the writer
+        """
+
+        if self._put(None):
+            self.thread.join()
+        try:
+            self.writer.stop()
+        except socket.error as sock_err:
+            self.logger.warning('Failed to stop writer: %s', str(sock_err))
+
+    def _put(self, item):
+        """
+        Queues the item, waiting while the queue is full as long as the
+        background thread is running
+
+        Arguments:
+        item - the item to queue (None stops the background thread)
+
+        Returns:
+        True if the item was queued; False if the background thread is not
+        running (the item is discarded)
+        """
+
+        while self.thread.is_alive():
+            try:
+                self.queue.put(item, True, METRIC_BATCH_PUT_TIMEOUT)
+                return True
+            except Queue.Full:
+                continue
+
+        self.logger.warning('Metric batching thread is not running; '
+                            'discarding queued metrics')
+        return False
+
+    def _run(self):
+        """
+        Background thread that sends the queued metrics in batches until
+        close() is called
+        """
+
+        closed = False
+        while not closed:
+            batch = [self.queue.get()]
+            count = len(batch[0][0]) if batch[0] else 0
+            deadline = time.time() + self.interval
+            while batch[-1] is not None and count < self.max_metrics:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(True, timeout))
+                except Queue.Empty:
+                    break
+                if batch[-1] is not None:
+                    count = count + len(batch[-1][0])
+
+            if batch[-1] is None:
+                closed = True
+                batch.pop()
+            self._send(batch)
+
+    #pylint: disable=bare-except
+    #pylint: disable=protected-access
+    def _send(self, batch):
+        """
+        Sends a batch of queued writes to the writer with a single write.
+        Failed writes are retried (METRIC_BATCH_SEND_ATTEMPTS attempts in
+        total) with the same backoff as NewRelicCommand.send_metric().  The
+        writes that reached the writer's buffer before a failure are not
+        repeated.
+
+        Arguments:
+        batch - list of (metrics, timestamp, source, point_tags) tuples
+        """
+
+        index = 0
+        attempts = 0
+        while True:
+            try:
+                while index < len(batch):
+                    metrics, timestamp, source, point_tags = batch[index]
+                    self.writer.transmit_metrics(metrics, timestamp, source,
+                                                 point_tags)
+                    index = index + 1
+                self.writer.flush()
+                return
+
+            except:
+                attempts = attempts + 1
+                if (attempts >= METRIC_BATCH_SEND_ATTEMPTS or
+                        utils.CANCEL_WORKERS_EVENT.is_set()):
+                    self.logger.warning(
+                        'Failed to transmit %d batched write(s); giving up: '
+                        '%s', len(batch) - index, str(sys.exc_info()))
+                    return
+
+                self.logger.warning('Failed to transmit batched writes '
+                                    '(attempt %d): %s',
+                                    attempts, str(sys.exc_info()))
+                NewRelicCommand._sleep_backoff(attempts - 1)
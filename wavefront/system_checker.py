@@ -12,19 +12,35 @@ import httplib
 import logging
 import os
 import os.path
+import re
 import socket
 import sys
+import threading
 import time
 
+from multiprocessing.pool import ThreadPool
 import wavefront_client
 from wavefront_client.rest import ApiException
 from wavefront.utils import Configuration
 from wavefront import command
 from wavefront import utils
 
+# os.scandir() (Python 3.5+ or the scandir package) returns each directory
+# entry's stat information with it; o/w os.listdir() and os.stat() are used
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
 # default location for the configuration file.
 DEFAULT_CONFIG_FILE_PATH = '/opt/wavefront/etc/system_checker.conf'
 
+# maximum number of threads hashing files at the same time
+MAX_HASH_WORKERS = 8
+
 #pylint: disable=too-many-instance-attributes
 class SystemCheckerConfiguration(Configuration):
     """
@@ -53,15 +69,36 @@ class SystemCheckerConfiguration(Configuration):
         self.find_file_patterns = self.getlist('find_files', 'patterns', [])
         self.find_file_event_names = self.getlist(
             'find_files', 'event_names', [])
+        # patterns compiled once (None for empty patterns)
+        self.find_file_regexes = [
+            re.compile(fnmatch.translate(pattern)) if pattern else None
+            for pattern in self.find_file_patterns]
 
         # section: files_changed
         self.file_changed_files = self.getlist('file_changes', 'files', [])
         self.file_changed_event_names = self.getlist(
             'file_changes', 'event_names', [])
+        # skip hashing files whose modification time and size are the same
+        # as when they were last hashed.  off by default: a file can be
+        # changed without changing either (e.g., touch -r)
+        self.file_changed_skip_unmodified = self.getboolean(
+            'file_changes', 'skip_unmodified', False)
 
         # other instance variables (non-configuration)
         self.md5_config = None
         self.md5_hashes = None
+        self.md5_stats = None
+        # full path of file found => ((inode, mtime, size), md5 hash value)
+        self.found_file_hashes = {}
+        # directory where files are found => its find-files cache directory
+        self.found_file_cache_dirs = {}
+        # find-files cache directory => set of file names in it
+        self.found_file_cache_names = {}
+        # guards the caches and the md5 config file (files are checked by
+        # multiple threads)
+        self.lock = threading.RLock()
+        # True when md5_config has changes not saved yet (see flush())
+        self.md5_config_dirty = False
 
         # initialize the cache directory
         self._init_cache()
@@ -83,14 +120,34 @@ class SystemCheckerConfiguration(Configuration):
             items = self.md5_config.config.items('hashes')
             for item in items:
                 self.md5_hashes[item[0]] = item[1]
+        # the modification time and size of each file when it was hashed
+        self.md5_stats = {}
+        if self.md5_config.has_section('stats'):
+            items = self.md5_config.config.items('stats')
+            for item in items:
+                self.md5_stats[item[0]] = item[1]
 
         # create directory to store hashes of files found
         for path in self.find_file_locations:
-            cache_path = os.path.join(
-                self.cache_location, 'find-files', utils.sanitize_name(path))
+            cache_path = self._get_file_found_cache_dir(path)
             if not os.path.exists(cache_path):
                 os.makedirs(cache_path)
 
+    def _get_file_found_cache_dir(self, directory):
+        """
+        Gets the cache directory for files found in the given directory.  The
+        path is built once per directory.
+        Arguments:
+        directory - the directory where the files are found
+        """
+
+        cache_path = self.found_file_cache_dirs.get(directory)
+        if cache_path is None:
+            cache_path = os.path.join(self.cache_location, 'find-files',
+                                      utils.sanitize_name(directory))
+            self.found_file_cache_dirs[directory] = cache_path
+        return cache_path
+
     def _get_file_found_cache_path(self, directory, filename, hashval):
         """
         Gets the file for a specific file and hash value combo for the cache
@@ -101,8 +158,7 @@ class SystemCheckerConfiguration(Configuration):
         hashval - the md5 hash value of the file found
         """
 
-        cache_path = os.path.join(
-            self.cache_location, 'find-files', utils.sanitize_name(directory))
+        cache_path = self._get_file_found_cache_dir(directory)
         sfilename = utils.sanitize_name(filename) + '_' + hashval
         return os.path.join(cache_path, sfilename)
 
@@ -117,7 +173,28 @@ class SystemCheckerConfiguration(Configuration):
 
         final_path = self._get_file_found_cache_path(
             directory, filename, hashval)
-        return os.path.exists(final_path)
+        cache_path, sfilename = os.path.split(final_path)
+        return sfilename in self._get_file_found_cache_names(cache_path)
+
+    def _get_file_found_cache_names(self, cache_path):
+        """
+        Gets the set of file names in the given find-files cache directory.
+        The directory is listed once and the set is kept up to date by
+        set_file_found().
+
+        Arguments:
+        cache_path - the cache directory
+        """
+
+        with self.lock:
+            names = self.found_file_cache_names.get(cache_path)
+            if names is None:
+                if os.path.isdir(cache_path):
+                    names = set(os.listdir(cache_path))
+                else:
+                    names = set()
+                self.found_file_cache_names[cache_path] = names
+            return names
 
     def set_file_found(self, directory, filename, hashval):
         """
@@ -132,6 +209,9 @@ class SystemCheckerConfiguration(Configuration):
             directory, filename, hashval)
         with open(final_path, 'a'):
             os.utime(final_path, None)
+        cache_path, sfilename = os.path.split(final_path)
+        with self.lock:
+            self._get_file_found_cache_names(cache_path).add(sfilename)
 
     def validate(self):
         """
@@ -148,18 +228,47 @@ class SystemCheckerConfiguration(Configuration):
             raise ValueError('find_files:paths must have the same number of '
                              'elements as find_files:event_names')
 
-    def set_expected_hash(self, filename, hashval):
+    def set_expected_hash(self, filename, hashval, stat_key=None):
         """
-        Sets the expected hash value for the given index
+        Sets the expected hash value for the given index.  The change is
+        saved to disk by flush().
 
         Arguments:
         filename - the name of the file
         hashval - the md5 hash value to update to
+        stat_key - the file's stat key when hashed (see get_stat_key())
         """
 
-        self.md5_hashes[filename] = hashval
-        self.md5_config.set('hashes', filename, hashval)
-        self.md5_config.save()
+        with self.lock:
+            self.md5_hashes[filename] = hashval
+            self.md5_config.set('hashes', filename, hashval)
+            if stat_key:
+                self.md5_stats[filename] = stat_key
+                self.md5_config.set('stats', filename, stat_key)
+            self.md5_config_dirty = True
+
+    def flush(self):
+        """
+        Saves the expected hash values set since the last flush (if any)
+        """
+
+        with self.lock:
+            if self.md5_config_dirty:
+                self.md5_config.save()
+                self.md5_config_dirty = False
+
+    @staticmethod
+    def get_stat_key(file_stat):
+        """
+        Gets the string identifying the contents of a file by its modification
+        time and size.  With file_changes.skip_unmodified enabled, the file is
+        not hashed again while this is unchanged.
+
+        Arguments:
+        file_stat - the os.stat() result for the file
+        """
+
+        return '%r,%d' % (file_stat.st_mtime, file_stat.st_size)
 
 class SystemCheckerCommand(command.Command):
     """
@@ -283,51 +392,112 @@ class SystemCheckerCommand(command.Command):
 
         self.logger.info('Checking files in ' +
                          str(self.config.find_file_locations))
-        for path in self.config.find_file_locations:
-            self.logger.info('Looking for matching files in %s ...', path)
-            if not os.path.exists(path):
-                self.logger.warning('Path %s does not exist.', path)
-                continue
-
-            for filename in os.listdir(path):
-                loc = 0
-                for pattern in self.config.find_file_patterns:
-                    if pattern and fnmatch.fnmatch(filename, pattern):
-                        fullpath = os.path.join(path, filename)
-                        hashval = utils.hashfile(fullpath, hashlib.md5())
-                        if self.config.has_file_found_cache_path(
-                                path, filename, hashval):
-                            continue
-                        self.logger.warning('[%s: %s] Found file "%s" matching '
-                                            'pattern "%s"', self.description,
-                                            path, filename, pattern)
-                        created = os.path.getctime(fullpath)
-                        name = self.config.find_file_event_names[loc]
-                        if self._send_event(
-                                name + ' found',
-                                name + ' file found: ' + fullpath,
-                                created,
-                                created,
-                                'Warning',
-                                name):
-                            self.config.set_file_found(path, filename, hashval)
-
-                        loc = loc + 1
+        # one thread per path so that a single disk is not over-subscribed
+        paths = self.config.find_file_locations
+        if not paths:
+            return
+        pool = ThreadPool(min(MAX_HASH_WORKERS, len(paths)))
+        try:
+            pool.map(self._check_path_for_files_matching, paths)
+        finally:
+            pool.close()
+            pool.join()
+
+    def _check_path_for_files_matching(self, path):
+        """
+        Checks for files matching a pattern in the given path
+
+        Arguments:
+        path - the directory to check
+        """
+
+        self.logger.info('Looking for matching files in %s ...', path)
+        if not os.path.exists(path):
+            self.logger.warning('Path %s does not exist.', path)
+            return
+
+        patterns = zip(self.config.find_file_patterns,
+                       self.config.find_file_regexes,
+                       self.config.find_file_event_names)
+        for filename, fullpath, entry in _list_dir(path):
+            for pattern, regex, name in patterns:
+                if not regex or not regex.match(filename):
+                    continue
+
+                # each file is hashed and reported once (for the first
+                # pattern it matches)
+                if entry is not None:
+                    file_stat = entry.stat()
+                else:
+                    file_stat = os.stat(fullpath)
+                hashval = self._get_found_file_hash(fullpath, file_stat)
+                if self.config.has_file_found_cache_path(
+                        path, filename, hashval):
+                    break
+                self.logger.warning('[%s: %s] Found file "%s" matching '
+                                    'pattern "%s"', self.description,
+                                    path, filename, pattern)
+                created = file_stat.st_ctime
+                if self._send_event(
+                        name + ' found',
+                        name + ' file found: ' + fullpath,
+                        created,
+                        created,
+                        'Warning',
+                        name):
+                    self.config.set_file_found(path, filename, hashval)
+                break
+
+    def _get_found_file_hash(self, fullpath, file_stat):
+        """
+        Gets the md5 hash value of a file found.  The file is only hashed
+        again when its inode, modification time or size changed since the
+        last time it was hashed.
+
+        Arguments:
+        fullpath - the full path to the file
+        file_stat - the os.stat() result for the file
+        """
+
+        stat_key = (file_stat.st_ino, file_stat.st_mtime, file_stat.st_size)
+        cached = self.config.found_file_hashes.get(fullpath)
+        if cached and cached[0] == stat_key:
+            return cached[1]
+
+        hashval = utils.hashfile(fullpath, hashlib.md5())
+        self.config.found_file_hashes[fullpath] = (stat_key, hashval)
+        return hashval
 
     def _check_for_files_changed(self):
         """
         Checks the hash (md5 currently) for each file configured
         """
 
-        loc = 0
-        for path in self.config.file_changed_files:
-            try:
-                self._check_file_hash(
-                    path, self.config.file_changed_event_names[loc])
-            except IOError as ioe:
-                self.logger.error('Unable to check MD5 for %s: %s',
-                                  path, str(ioe))
-            loc = loc + 1
+        tasks = zip(self.config.file_changed_files,
+                    self.config.file_changed_event_names)
+        if not tasks:
+            return
+        pool = ThreadPool(min(MAX_HASH_WORKERS, len(tasks)))
+        try:
+            pool.map(self._check_file_hash_task, tasks)
+        finally:
+            pool.close()
+            pool.join()
+
+    def _check_file_hash_task(self, task):
+        """
+        Runs _check_file_hash() in the hash pool and logs any I/O failure
+
+        Arguments:
+        task - tuple of (path, event name)
+        """
+
+        path, event_name = task
+        try:
+            self._check_file_hash(path, event_name)
+        except (IOError, OSError) as ioe:
+            self.logger.error('Unable to check MD5 for %s: %s',
+                              path, str(ioe))
 
     def _check_file_hash(self, path, event_name):
         """
@@ -338,38 +508,60 @@ class SystemCheckerCommand(command.Command):
         """
 
         self.logger.info('Checking MD5 for %s ...', path)
-        hashval = utils.hashfile(path, hashlib.md5())
         abspath = os.path.abspath(path)
-        if (abspath not in self.config.md5_hashes or
-                not self.config.md5_hashes[abspath]):
-            # assume this is the first run
-            self.config.set_expected_hash(abspath, hashval)
-
-        else:
-            expected_hashval = self.config.md5_hashes[abspath]
-
-            if expected_hashval != hashval:
-                modified = os.path.getmtime(path) * 1000
-                self.logger.warning('[%s: %s] MD5 mismatch. '
-                                    'Expected: %s; Found: %s',
-                                    self.description, path, expected_hashval,
-                                    hashval)
-                self._send_event('File Change (' + path + ')',
-                                 'File Change (' + path + ')',
-                                 modified,
-                                 modified,
-                                 'Informational',
-                                 event_name)
-
-                # update the new expected hash to this value
-                self.config.set_expected_hash(abspath, hashval)
+        stat_key = self.config.get_stat_key(os.stat(path))
+        if (self.config.file_changed_skip_unmodified and
+                self.config.md5_hashes.get(abspath) and
+                self.config.md5_stats.get(abspath) == stat_key):
+            # not modified since it was last hashed
+            return
+
+        hashval = utils.hashfile(path, hashlib.md5())
+        expected_hashval = self.config.md5_hashes.get(abspath)
+        # no expected hash value: assume this is the first run
+        if expected_hashval and expected_hashval != hashval:
+            modified = os.path.getmtime(path) * 1000
+            self.logger.warning('[%s: %s] MD5 mismatch. '
+                                'Expected: %s; Found: %s',
+                                self.description, path, expected_hashval,
+                                hashval)
+            self._send_event('File Change (' + path + ')',
+                             'File Change (' + path + ')',
+                             modified,
+                             modified,
+                             'Informational',
+                             event_name)
+
+        # update the expected hash to this value.  the stat key is updated
+        # even when the contents are the same so the file is not hashed
+        # again until it is modified (when skip_unmodified is enabled)
+        self.config.set_expected_hash(abspath, hashval, stat_key)
 
     def _execute(self):
         """
         Starts looking for matching files, changed files, etc as configured
         """
 
-        if not utils.CANCEL_WORKERS_EVENT.is_set():
-            self._check_for_files_matching()
-        if not utils.CANCEL_WORKERS_EVENT.is_set():
-            self._check_for_files_changed()
+        try:
+            if not utils.CANCEL_WORKERS_EVENT.is_set():
+                self._check_for_files_matching()
+            if not utils.CANCEL_WORKERS_EVENT.is_set():
+                self._check_for_files_changed()
+        finally:
+            self.config.flush()
+
+def _list_dir(path):
+    """
+    Lists the entries in the given directory
+
+    Arguments:
+    path - the directory
+
+    Returns:
+    List of (name, full path, scandir entry or None) tuples
+    """
+
+    if scandir is None:
+        return [(name, os.path.join(path, name), None)
+                for name in os.listdir(path)]
+    return [(entry.name, entry.path, entry) for entry in scandir(path)]
@@ -3,19 +3,31 @@ Utility functions
 """
 
 import ConfigParser
+import Queue
+import calendar
 import csv
 import datetime
+import hashlib
+import io
+import logging
 import os.path
 import re
 import signal
+import string
 import sys
 import threading
 import traceback
-import urllib
 
 import dateutil
+import dateutil.parser
 import dateutil.tz
 
+# ciso8601 (optional) parses ISO 8601 strings much faster than dateutil
+try:
+    import ciso8601
+except ImportError:
+    ciso8601 = None
+
 EPOCH = (datetime.datetime.utcfromtimestamp(0)
          .replace(tzinfo=dateutil.tz.tzutc()))
 def unix_time_seconds(date_in):
@@ -24,58 +36,137 @@ def unix_time_seconds(date_in):
     Arguments:
     date_in - the datetime object to convert. This must have a tz = UTC
     """
-    if not date_in.tzinfo or date_in.tzinfo != dateutil.tz.tzutc():
-        date_in = date_in.replace(tzinfo=dateutil.tz.tzutc())
-    return (date_in - EPOCH).total_seconds()
-
-def urlencode_utf8(params):
-    """
-    Encode with utf8 characters.
-    See: http://stackoverflow.com/a/8152242
-    """
-    if hasattr(params, 'items'):
-        params = params.items()
-    encoded = []
-    for key, value in params:
-        key = urllib.quote_plus(key.encode('utf8'), safe='/')
-        if isinstance(value, list):
-            for item in value:
-                if isinstance(item, basestring):
-                    item = urllib.quote_plus(item.encode('utf8'), safe='/')
-                encoded.append('%s=%s' % (key, item))
-            continue
+    # the date/time fields are always treated as UTC (any other tzinfo is
+    # replaced, not converted) so they can be passed to timegm() directly
+    return ((calendar.timegm(date_in.timetuple()) * 1000000 +
+             date_in.microsecond) / 1e6)
+
+# formats of the dates written by this tool (see datetime.isoformat())
+DATETIME_FORMATS = ('%Y-%m-%dT%H:%M:%S+00:00', '%Y-%m-%dT%H:%M:%S')
+def parse_datetime(value):
+    """
+    Parses a date/time string.  ISO 8601 strings are parsed with ciso8601
+    (when installed) or, for the formats in DATETIME_FORMATS, strptime();
+    anything else is parsed by dateutil.parser.parse().
 
-        if isinstance(value, basestring):
-            value = urllib.quote_plus(value.encode('utf8'), safe='/')
+    Arguments:
+    value - the string to parse
 
-        encoded.append('%s=%s' % (key, value))
+    Returns:
+    datetime object (timezone aware if the string has an offset)
+    """
+
+    if ciso8601 is not None:
+        try:
+            return ciso8601.parse_datetime(value)
+        except ValueError:
+            pass
 
-    return '&'.join(encoded)
+    for fmt in DATETIME_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+
+    return dateutil.parser.parse(value)
+
+# path of configuration file => (stat key, RawConfigParser of its contents)
+# see Configuration._read()
+_CONFIG_CACHE = {}
 
 class Configuration(object):
     """
     Base class for configurations that read from an INI file
     """
 
-    def __init__(self, config_file_path, create_if_not_exist=False):
+    def __init__(self, config_file_path, create_if_not_exist=False,
+                 interpolate=False):
+        """
+        Arguments:
+        config_file_path - the path to the INI file
+        create_if_not_exist - allow the file to not exist (yet)
+        interpolate - expand %(name)s references in values on get()
+                      (values are returned as is by default)
+        """
+
         super(Configuration, self).__init__()
         if not os.path.exists(config_file_path) and not create_if_not_exist:
             raise ValueError('Configuration file %s does not exist' %
                              (config_file_path))
         self.config_file_path = config_file_path
-        self.config = ConfigParser.ConfigParser()
-        self.config.read(config_file_path)
+        if interpolate:
+            self.config = ConfigParser.ConfigParser()
+        else:
+            self.config = ConfigParser.RawConfigParser()
+        self._read(config_file_path)
+
+    def _read(self, config_file_path):
+        """
+        Reads the configuration file into self.config.  The parsed file is
+        cached by path and its contents are copied into self.config while the
+        file's inode, modification/change times and size stay the same.
+
+        Arguments:
+        config_file_path - the path to the configuration file
+        """
+
+        try:
+            file_stat = os.stat(config_file_path)
+        except OSError:
+            # the file does not exist (yet)
+            self.config.read(config_file_path)
+            return
+
+        stat_key = (file_stat.st_dev, file_stat.st_ino, file_stat.st_mtime,
+                    file_stat.st_ctime, file_stat.st_size)
+        cached = _CONFIG_CACHE.get(config_file_path)
+        if cached is None or cached[0] != stat_key:
+            parsed = ConfigParser.RawConfigParser()
+            parsed.read(config_file_path)
+            cached = (stat_key, parsed)
+            _CONFIG_CACHE[config_file_path] = cached
+
+        # each instance gets its own copy since set() changes the sections.
+        # items() includes the defaults so only the values that differ from
+        # the defaults are set in the section
+        parsed = cached[1]
+        defaults = parsed.defaults()
+        for key, value in defaults.iteritems():
+            self.config.set(ConfigParser.DEFAULTSECT, key, value)
+        for section in parsed.sections():
+            self.config.add_section(section)
+            for key, value in parsed.items(section):
+                if key not in defaults or defaults[key] != value:
+                    self.config.set(section, key, value)
 
     def has_section(self, section):
         """
         Checks to see if the given section exists
         """
-        try:
-            self.config.get(section, "test")
-        except ConfigParser.NoOptionError:
-            return True
-        except ConfigParser.NoSectionError:
-            return False
+        return self.config.has_section(section)
+
+    def _raw_get(self, section, key, fallback_section=None):
+        """
+        Looks up the key in the section and then in the fallback section.
+
+        Arguments:
+        section - the section name
+        key - the key in the section to retrieve
+        fallback_section - the section to look in when section/key not found
+
+        Returns:
+        tuple of (value, found); value is None when not found
+        """
+
+        for name in (section, fallback_section):
+            if name is None:
+                continue
+            try:
+                return (self.config.get(name, key), True)
+            except (ConfigParser.NoOptionError, ConfigParser.NoSectionError):
+                continue
+
+        return (None, False)
 
     def get(self, section, key, default_value, default_section=None):
         """
@@ -88,21 +179,10 @@ class Configuration(object):
         default_value - the default value to return when section/key not found
         """
 
-        try:
-            value = self.config.get(section, key)
-        except ConfigParser.NoOptionError:
-            value = None
-        except ConfigParser.NoSectionError:
-            value = None
-
-
-        if value is None:
-            if default_section:
-                return self.get(default_section, key, default_value, None)
-            else:
-                return default_value
-        else:
+        value, found = self._raw_get(section, key, default_section)
+        if found:
             return value
+        return default_value
 
     def getdate(self, section, key, default_value, default_section=None):
         """
@@ -116,15 +196,16 @@ class Configuration(object):
         default_value - the default value to return when section/key not found
         """
 
-        value = self.get(section, key, None)
-        if value:
-            return (dateutil.parser.parse(value)
-                    .replace(microsecond=0, tzinfo=dateutil.tz.tzutc()))
-        elif default_section:
-            return self.getdate(default_section, key, default_value, None)
-        else:
-            return default_value
+        sections = (section, default_section) if default_section else (section,)
+        for name in sections:
+            value = self.get(name, key, None)
+            if value:
+                return (parse_datetime(value)
+                        .replace(microsecond=0, tzinfo=dateutil.tz.tzutc()))
+
+        return default_value
 
+    #pylint: disable=protected-access
     def getboolean(self, section, key, default_value, default_section=None):
         """
         Gets a value from the configuration and returns the default if the
@@ -136,21 +217,13 @@ class Configuration(object):
         default_value - the default value to return when section/key not found
         """
 
+        value, found = self._raw_get(section, key, default_section)
+        if not found:
+            return default_value
         try:
-            value = self.config.getboolean(section, key)
-        except ConfigParser.NoOptionError:
-            value = None
-        except ConfigParser.NoSectionError:
-            value = None
-
-        if value is None:
-            if default_section:
-                return self.getboolean(
-                    default_section, key, default_value, None)
-            else:
-                return default_value
-        else:
-            return value
+            return self.config._boolean_states[value.lower()]
+        except KeyError:
+            raise ValueError('Not a boolean: %s' % value)
 
     def getlist(self, section, key, default_value, default_section=None,
                 delimiter=',', trim=False):
@@ -167,23 +240,14 @@ class Configuration(object):
         trim - trim all items in the list
         """
 
-        try:
-            value = self.config.get(section, key)
-            if value:
-                value = value.split(delimiter)
-        except ConfigParser.NoOptionError:
-            value = None
-        except ConfigParser.NoSectionError:
-            value = None
-
-        if value is None:
-            if default_section:
-                value = self.getlist(default_section, key, default_value, None)
-            else:
-                value = default_value
+        value, found = self._raw_get(section, key, default_section)
+        if not found:
+            value = default_value
+        elif value:
+            value = value.split(delimiter)
 
         if trim:
-            return map(str.strip, value)
+            return [item.strip() for item in value]
         else:
             return value
 
@@ -214,6 +278,44 @@ class Configuration(object):
 
         with open(self.config_file_path, 'w') as configfile:
             self.config.write(configfile)
+        _CONFIG_CACHE.pop(self.config_file_path, None)
+
+# default replace_map of sanitize_name() (applied in order)
+DEFAULT_SANITIZE_REPLACE_MAP = (
+    ('*', 'all'),
+    ('.', '_'),
+    ('|', '.'),
+    ('//', '.'),
+    ('/', '.')
+)
+# the single character replacements of the default replace_map applied in
+# one pass with translate() (str and unicode versions)
+_SANITIZE_TABLE = string.maketrans('.|/', '_..')
+_SANITIZE_UNICODE_TABLE = {ord(u'.'): u'_', ord(u'|'): u'.', ord(u'/'): u'.'}
+# characters sanitize_name() replaces with _
+SANITIZE_NAME_RE = re.compile(r'[^a-z\-_0-9\.]')
+
+def _build_sanitize_bytes_table():
+    """
+    Builds the 256 byte translate() table that does all of the default
+    sanitize_name() work except the '*' and '//' replacements in one pass:
+    lower cases A-Z, applies the single character replacements and replaces
+    the characters not matching SANITIZE_NAME_RE with _
+    """
+
+    table = []
+    for code in range(256):
+        char = chr(code)
+        if 'A' <= char <= 'Z':
+            char = char.lower()
+        else:
+            char = char.translate(_SANITIZE_TABLE)
+            if SANITIZE_NAME_RE.match(char):
+                char = '_'
+        table.append(char)
+    return ''.join(table)
+
+_SANITIZE_BYTES_TABLE = _build_sanitize_bytes_table()
 
 def sanitize_name(_name, replace_map=None):
     """
@@ -227,29 +329,59 @@ def sanitize_name(_name, replace_map=None):
 
     Arguments:
     _name - the name to sanitize
+    replace_map - optional list of {search: replace} dicts and/or
+                  (search, replace) pairs to apply (in order) instead of the
+                  default list
 
     Returns:
     Sanitized name
     """
 
-    if not replace_map:
-        replace_map = [
-            {'*': 'all'},
-            {'.': '_'},
-            {'|': '.'},
-            {'//': '.'},
-            {'/': '.'}
-        ]
+    if not replace_map and isinstance(_name, str):
+        # fast path: byte strings are sanitized with a single translate()
+        # pass over the bytes (unicode goes through the path below so the
+        # result stays unicode)
+        name = _name.replace('*', 'all').replace('//', '/')
+        return name.translate(_SANITIZE_BYTES_TABLE)
 
     # see http://stackoverflow.com/a/27086669 for details on performance
     # of various methods of doing this
     name = _name.lower()
-    for items in replace_map:
-        for search, replace in items.iteritems():
+    if not replace_map:
+        # same result as applying DEFAULT_SANITIZE_REPLACE_MAP in order:
+        # '//' => '/' followed by '/' => '.' is the same as '//' => '.'
+        name = name.replace('*', 'all').replace('//', '/')
+        if isinstance(name, unicode):
+            name = name.translate(_SANITIZE_UNICODE_TABLE)
+        else:
+            name = name.translate(_SANITIZE_TABLE)
+    else:
+        for search, replace in _get_replace_pairs(replace_map):
             name = name.replace(search, replace)
-    name = re.sub(r'[^a-z\-_0-9\.]', '_', name)
+    name = SANITIZE_NAME_RE.sub('_', name)
     return name
 
+def _get_replace_pairs(replace_map):
+    """
+    Flattens a sanitize_name() replace_map into a list of
+    (search, replace) pairs
+
+    Arguments:
+    replace_map - list of {search: replace} dicts and/or (search, replace)
+                  pairs
+
+    Returns:
+    list of (search, replace) tuples in the order they are applied
+    """
+
+    pairs = []
+    for items in replace_map:
+        if hasattr(items, 'iteritems'):
+            pairs.extend(items.iteritems())
+        else:
+            pairs.append(items)
+    return pairs
+
 # Mapping for product names found in the CSV file to the metric prefix name
 PRODUCT_NAME_TO_PREFIX = {
     'AmazonCloudWatch': 'cloudwatch',
@@ -275,40 +407,12 @@ def get_aws_product_short_name(product):
     name prefix for it (e.g., "cloudtrail")
     """
 
-    if product in PRODUCT_NAME_TO_PREFIX:
-        return PRODUCT_NAME_TO_PREFIX[product]
-    else:
-        return product.replace(' ', '')
-
-#pylint: disable=too-few-public-methods
-class LockedIterator(object):
-    """
-    thread-safe iterator
-    """
-
-    def __init__(self, iterator):
-        self.lock = threading.Lock()
-        self.iterator = iterator.__iter__()
-
-    def __iter__(self):
-        return self
-
-    def next(self):
-        """
-        Get the next item in the iterator.
-        Returns:
-        The next item in the iteration
-        Throws:
-        StopIterator if next not found
-        """
-
-        self.lock.acquire()
-        try:
-            return self.iterator.next()
-        finally:
-            self.lock.release()
+    return PRODUCT_NAME_TO_PREFIX.get(product) or product.replace(' ', '')
 
 CANCEL_WORKERS_EVENT = threading.Event()
+# seconds parallel_process_and_wait()'s producer waits on a full work queue
+# before checking whether the workers are still running
+WORK_QUEUE_PUT_TIMEOUT = 1.0
 def parallel_process_and_wait(iterator, workers, logger=None):
     """
     Process an iterator of function pointers in parallel using the number
@@ -321,54 +425,139 @@ def parallel_process_and_wait(iterator, workers, logger=None):
                each item should be a tuple of (function, (args))
     workers - number of workers (threads)
     """
-    locked_iterator = LockedIterator(iterator)
+
+    # the last worker to exit sets done_event
+    done_event = threading.Event()
+    if workers <= 0:
+        done_event.set()
+    remaining = [workers]
+    remaining_lock = threading.Lock()
+    def worker_finished():
+        """
+        Called by each worker thread when it exits
+        """
+
+        with remaining_lock:
+            remaining[0] = remaining[0] - 1
+            if remaining[0] <= 0:
+                done_event.set()
+
+    # work items are handed to the workers through a bounded queue filled
+    # by a producer thread so the iterator is only consumed by one thread
+    work_queue = Queue.Queue(maxsize=max(workers, 1) * 4)
+    producer = threading.Thread(
+        target=_produce_work,
+        args=(iterator, work_queue, workers, done_event, logger))
+    producer.daemon = True
+    producer.start()
 
     # start the threads
     group = []
     for _ in range(workers):
         thread = threading.Thread(target=worker,
-                                  args=(locked_iterator, logger))
+                                  args=(work_queue, logger, worker_finished))
         thread.daemon = True
         thread.start()
         group.append(thread)
 
     # wait for all threads to finish
-    # this while loop is here with a .join(timeout) because sometimes
-    # a few threads seem to get "stuck" so we added a way to get debug
-    # information every 60 seconds.
+    # this loop wakes up every 60 seconds because sometimes a few threads
+    # seem to get "stuck" so we added a way to get debug information.
     iterations = 0
-    active = 1
-    while active and group and not CANCEL_WORKERS_EVENT.is_set():
-        iterations = iterations + 1
-        active = 0
-        for thread in group:
-            thread.join(60.0)
-            if thread.is_alive():
-                active = active + 1
+    while group and not done_event.wait(60.0):
+        if CANCEL_WORKERS_EVENT.is_set():
+            return
 
-        if logger and active:
+        iterations = iterations + 1
+        if logger:
+            active = len([thread for thread in group if thread.is_alive()])
             logger.debug('%d active thread(s) of %d total threads remaining',
                          active, len(group))
             if iterations % 5 == 0:
                 dump_stack_traces(logger)
 
+    for thread in group:
+        thread.join()
+
 #pylint: disable=bare-except
-def worker(locked_iterator, logger=None):
+def _produce_work(iterator, work_queue, workers, done_event, logger=None):
+    """
+    Producer thread created in parallel_process_and_wait().  Puts each item
+    of the iterator on the queue followed by one None (stop marker) per
+    worker.  Stops early when the workers are cancelled or have all exited.
+    Arguments:
+    iterator - the iterable of (function, (args)) tuples
+    work_queue - the Queue.Queue the workers read from
+    workers - number of worker threads
+    done_event - threading.Event set when all workers have exited
+    logger - optional logger object
+    """
+
+    try:
+        for call_details in iterator:
+            if not _put_work(work_queue, call_details, done_event):
+                return
+
+    except:
+        if logger:
+            logger.exception('Failed to produce thread worker items')
+
+    for _ in range(workers):
+        if not _put_work(work_queue, None, done_event):
+            return
+
+def _put_work(work_queue, item, done_event):
+    """
+    Puts the item on the work queue, waiting while the queue is full.
+    Arguments:
+    work_queue - the Queue.Queue the workers read from
+    item - the item to put on the queue
+    done_event - threading.Event set when all workers have exited
+
+    Returns:
+    True if the item was queued; False if the workers were cancelled or
+    have all exited (nothing will read the queue any more)
+    """
+
+    while True:
+        if CANCEL_WORKERS_EVENT.is_set() or done_event.is_set():
+            return False
+        try:
+            work_queue.put(item, True, WORK_QUEUE_PUT_TIMEOUT)
+            return True
+        except Queue.Full:
+            continue
+
+#pylint: disable=bare-except
+def worker(work_queue, logger=None, finished=None):
     """
     Worker for each thread created in parallel_process_and_wait()
     Arguments:
-    locked_iterator - LockedIterator (thread-safe) iterator
+    work_queue - Queue.Queue of (function, (args)) tuples; None marks the end
     logger - optional logger object
+    finished - optional function called when this worker exits
+    """
+
+    try:
+        _run_worker(work_queue, logger)
+    finally:
+        if finished:
+            finished()
+
+#pylint: disable=bare-except
+def _run_worker(work_queue, logger):
+    """
+    Runs the work items from the queue until the end marker is found,
+    a work item fails or the workers are cancelled
     """
 
     while not CANCEL_WORKERS_EVENT.is_set():
         try:
-            call_details = locked_iterator.next()
+            call_details = work_queue.get()
+            if call_details is None:
+                break
             call_details[0](*call_details[1])
 
-        except StopIteration:
-            break
-
         except:
             if logger:
                 logger.exception('Failed to run thread worker')
@@ -407,33 +596,52 @@ def setup_signal_handlers(logger):
 #pylint: disable=protected-access
 def dump_stack_traces(logger=None):
     """
-    Prints stack traces of all threads
+    Prints stack traces of all threads (logged at INFO level when a logger
+    is given; nothing is done when that level is disabled)
     """
 
-    out = []
-    out.append('Threads: %d\n' % (threading.active_count()))
-    for thread_id, stack in sys._current_frames().items():
-        out.append('\n# Thread %s:' % thread_id)
-        for filename, lineno, name, line in traceback.extract_stack(stack):
-            out.append('File: "%s", line %d, in %s' % (filename, lineno, name))
-            if line:
-                out.append("  %s" % (line.strip()))
+    if logger and not logger.isEnabledFor(logging.INFO):
+        return
+
+    out = ['Threads: %d\n' % (threading.active_count())]
+    out.extend('\n# Thread %s:\n%s' %
+               (thread_id, ''.join(traceback.format_stack(stack)).rstrip())
+               for thread_id, stack in sys._current_frames().items())
 
     if logger:
         logger.info('STACK TRACE:\n%s', '\n'.join(out))
     else:
         print 'STACK TRACE:\n%s' % ('\n'.join(out))
 
-def hashfile(file_path, hasher, blocksize=65536):
+# per thread read buffer used by hashfile()
+_HASHFILE_BUFFERS = threading.local()
+
+def hashfile(file_path, hasher, blocksize=1 << 20):
     """
+    Updates hasher with the contents of the given file and returns its
+    hex digest.  The file is read in (1 MiB by default) blocks into a buffer
+    reused by all calls in the same thread.  Files are not memory mapped
+    since a mapped file that shrinks (e.g., a rotated log) kills the process
+    with SIGBUS.
     See: http://stackoverflow.com/a/3431835
+
+    Arguments:
+    file_path - the path of the file to hash
+    hasher - the hashlib object (e.g., hashlib.md5())
+    blocksize - the number of bytes to read at a time
     """
 
-    with open(file_path, 'r') as afile:
-        buf = afile.read(blocksize)
-        while len(buf) > 0:
-            hasher.update(buf)
-            buf = afile.read(blocksize)
+    with io.open(file_path, 'rb', buffering=0) as afile:
+        # the read buffer is allocated once per thread and reused
+        buf = getattr(_HASHFILE_BUFFERS, 'buf', None)
+        if buf is None or len(buf) != blocksize:
+            buf = bytearray(blocksize)
+            _HASHFILE_BUFFERS.buf = buf
+        view = memoryview(buf)
+        size = afile.readinto(view)
+        while size:
+            hasher.update(view[:size])
+            size = afile.readinto(view)
         return hasher.hexdigest()
 
 class CsvFileRow(object):
@@ -441,11 +649,15 @@ class CsvFileRow(object):
     Row from CsvFile
     """
 
+    # one instance is created per row so avoid the per instance __dict__
+    __slots__ = ('csvfile', 'row', '_idx')
+
     def __init__(self, csvfile, row):
         """
         """
         self.csvfile = csvfile
         self.row = row
+        self._idx = csvfile.header_key_to_index
 
     def __str__(self):
         return str(self.row)
@@ -454,10 +666,10 @@ class CsvFileRow(object):
         return repr(self.row)
 
     def __getitem__(self, name):
-        if name not in self.csvfile.header_key_to_index:
-            raise ValueError('%s not in %s' %
-                             (name, str(self.csvfile.header_key_to_index)))
-        index = self.csvfile.header_key_to_index[name]
+        try:
+            index = self._idx[name]
+        except KeyError:
+            raise ValueError('%s not in %s' % (name, str(self._idx)))
         return self.row[index]
 
 class CsvFile(object):
@@ -475,16 +687,12 @@ class CsvFile(object):
         self.csvreader = csv.reader(reader)
 
         # build map for header name to index
-        index = 0
-        while index < header_row_index:
-            header_row = self.csvreader.next()
-            index = index + 1
-
-        self.header_key_to_index = {}
-        index = 0
-        for name in header_row:
-            self.header_key_to_index[name] = index
-            index = index + 1
+        for _ in range(header_row_index - 1):
+            next(self.csvreader)
+        header_row = next(self.csvreader)
+
+        self.header_key_to_index = {
+            intern(name): index for index, name in enumerate(header_row)}
 
     def __iter__(self):
         return self